@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# Stand-in for OpenKh.Command.IdxImg.exe so the bridge can be run on machines without OpenKH or a game install.
+# Only `hed extract <hed> -o <out>` and `hed patch <pkg> <modfolder> -o <out>` are supported.
+#
+# Assets use a made up, unencrypted layout: the asset's own name, its data and then the remastered
+# files that belong to it, so patching and extracting move about as much data as the real thing.
+# FAKE_IDXIMG_DELAY=<seconds> sleeps that long per asset, to watch progress, timeouts and cancelling.
+import os, sys, struct, time
+
+DELAY = float(os.environ.get("FAKE_IDXIMG_DELAY", 0))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import hedfile
+
+def packAsset(name, data, remastered):
+    parts = [struct.pack("<H", len(name.encode("utf-8"))), name.encode("utf-8"), struct.pack("<I", len(data)), data, struct.pack("<H", len(remastered))]
+    for subname in sorted(remastered):
+        parts += [struct.pack("<H", len(subname.encode("utf-8"))), subname.encode("utf-8"), struct.pack("<I", len(remastered[subname])), remastered[subname]]
+    return b"".join(parts)
+
+def unpackAsset(blob):
+    pos = 0
+    def take(fmt):
+        nonlocal pos
+        value = struct.unpack_from(fmt, blob, pos)[0]
+        pos += struct.calcsize(fmt)
+        return value
+    def takeBytes(length):
+        nonlocal pos
+        pos += length
+        return blob[pos-length:pos]
+    name = takeBytes(take("<H")).decode("utf-8")
+    data = takeBytes(take("<I"))
+    remastered = {}
+    for i in range(take("<H")):
+        subname = takeBytes(take("<H")).decode("utf-8")
+        remastered[subname] = takeBytes(take("<I"))
+    return name, data, remastered
+
+def writeFile(path, data):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").write(data)
+
+def extract(hed, out):
+    entries = hedfile.readHed(hed)
+    with open(hed[:-4]+".pkg", "rb") as pkg:
+        for i, entry in enumerate(entries):
+            pkg.seek(entry.offset)
+            name, data, remastered = unpackAsset(pkg.read(entry.data_length))
+            print("[{}/{}] Extracting {}".format(i+1, len(entries), name), flush=True)
+            time.sleep(DELAY)
+            writeFile(os.path.join(out, "original", name), data)
+            for subname, subdata in remastered.items():
+                writeFile(os.path.join(out, "remastered", name, subname), subdata)
+
+def scanMod(modfolder):
+    files = {}
+    remastered = {}
+    for folder in ["original", "raw", "remastered"]:
+        base = os.path.join(modfolder, folder)
+        for root, dirs, names in os.walk(base):
+            for fn in names:
+                relpath = os.path.relpath(os.path.join(root, fn), base).replace(os.sep, "/")
+                if folder == "remastered":
+                    name, subname = relpath.rsplit("/", 1)
+                    remastered.setdefault(name, {})[subname] = os.path.join(root, fn)
+                else:
+                    files[relpath] = os.path.join(root, fn)
+    return files, remastered
+
+def patch(pkgfile, modfolder, out):
+    files, remastered = scanMod(modfolder)
+    hashes = {hedfile.nameHash(name): name for name in set(files) | set(remastered)}
+    entries = hedfile.readHed(pkgfile[:-4]+".hed")
+    known = set(entry.name for entry in entries)
+    os.makedirs(out, exist_ok=True)
+    pkg = hedfile.pkgName(pkgfile)
+    newentries = []
+    total = len(entries) + len([h for h in hashes if h not in known])
+    with open(pkgfile, "rb") as src, open(os.path.join(out, pkg+".pkg"), "wb") as dst:
+        def writeAsset(hash, blob, actual_length):
+            newentries.append(hedfile.HedEntry(hash, dst.tell(), len(blob), actual_length))
+            dst.write(blob)
+        for i, entry in enumerate(entries):
+            src.seek(entry.offset)
+            blob = src.read(entry.data_length)
+            if entry.name in hashes:
+                name, data, subfiles = unpackAsset(blob)
+                print("[{}/{}] Patching {}".format(i+1, total, name), flush=True)
+                time.sleep(DELAY)
+                if name in files:
+                    data = open(files[name], "rb").read()
+                for subname, fn in remastered.get(name, {}).items():
+                    subfiles[subname] = open(fn, "rb").read()
+                blob = packAsset(name, data, subfiles)
+                writeAsset(entry.name, blob, len(data))
+            else:
+                writeAsset(entry.name, blob, entry.actual_length)
+        for hash, name in sorted(hashes.items()):
+            if hash in known or name not in files:
+                continue
+            print("[{}/{}] Adding {}".format(len(newentries)+1, total, name), flush=True)
+            data = open(files[name], "rb").read()
+            subfiles = {subname: open(fn, "rb").read() for subname, fn in remastered.get(name, {}).items()}
+            writeAsset(hash, packAsset(name, data, subfiles), len(data))
+    hedfile.writeHed(os.path.join(out, pkg+".hed"), newentries)
+
+def main(argv):
+    if len(argv) < 2 or argv[0] != "hed" or "-o" not in argv:
+        print("usage: hed extract <hed> -o <out> | hed patch <pkg> <modfolder> -o <out>")
+        return 1
+    out = argv[argv.index("-o")+1]
+    if argv[1] == "extract":
+        extract(argv[2], out)
+    elif argv[1] == "patch":
+        patch(argv[2], argv[3], out)
+    else:
+        print("unknown command {}".format(argv[1]))
+        return 1
+    io_log = os.environ.get("BENCH_IO_LOG")
+    if io_log and os.path.exists("/proc/self/io"):
+        with open(io_log, "a") as f:
+            f.write(open("/proc/self/io").read().replace("\n", " ") + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
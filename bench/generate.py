@@ -0,0 +1,93 @@
+# Generates a synthetic game install, Mods Manager output and .kh2pcpatch files for benchmarking,
+# in the layout fake_idximg.py understands
+import os, sys, json, random, hashlib, argparse
+from zipfile import ZipFile, ZIP_DEFLATED
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import hedfile
+from build_from_mm import games
+from fake_idximg import packAsset
+
+ASSET_DIRS = ["obj", "bgm", "effect", "msg/us", "itempic"]
+
+def pkgDir(root, gamename):
+    return os.path.normpath(games[gamename](region="us").translate_pkg_path(os.path.join(root, "game", "Image", "en")))
+
+def makeGame(root, gamename="kh2", assets_per_pkg=200, asset_size=64*1024, remastered_per_asset=1, seed=0):
+    #writes the pkg/hed pairs, a checksums.json in the format of build_from_mm.checksums and a pkgmap.json.
+    #returns {pkg: [asset names]}
+    rng = random.Random(seed)
+    pkgdir = pkgDir(root, gamename)
+    os.makedirs(pkgdir, exist_ok=True)
+    checksums = {}
+    pkgmap = {}
+    assets = {}
+    for pkgfn in games[gamename](region="us").pkgs:
+        pkg = pkgfn[:-4]
+        assets[pkg] = []
+        entries = []
+        with open(os.path.join(pkgdir, pkg+".pkg"), "wb") as f:
+            for i in range(assets_per_pkg):
+                name = "{}/{}_{:05d}.bin".format(rng.choice(ASSET_DIRS), pkg, i)
+                data = rng.randbytes(asset_size)
+                remastered = {"-{}.dds".format(j): rng.randbytes(asset_size) for j in range(remastered_per_asset)}
+                blob = packAsset(name, data, remastered)
+                entries.append(hedfile.HedEntry(hedfile.nameHash(name), f.tell(), len(blob), len(data)))
+                f.write(blob)
+                assets[pkg].append(name)
+                pkgmap[name.replace("/", "\\")] = [pkg]
+                for subname in remastered:
+                    pkgmap["remastered\\{}\\{}".format(name.replace("/", "\\"), subname)] = [pkg]
+        hedfile.writeHed(os.path.join(pkgdir, pkg+".hed"), entries)
+        for ext in [".pkg", ".hed"]:
+            checksums[pkg+ext] = hashlib.md5(open(os.path.join(pkgdir, pkg+ext), "rb").read()).hexdigest()
+    json.dump(checksums, open(os.path.join(root, "checksums.json"), "w"), indent=1)
+    json.dump({games[gamename](region="us").name: pkgmap}, open(os.path.join(root, "pkgmap.json"), "w"))
+    return assets
+
+def makeMods(root, assets, mod_files=100, patches=2, patch_files=100, file_size=64*1024, seed=1):
+    #Mods Manager output in <root>/openkh/mod and .kh2pcpatch files in <root>/patches, each replacing
+    #random existing assets. every fourth mod file is a remastered texture instead. sizes differ a little
+    #from the originals, like re-encoded files would, so the patched hed never matches the original
+    rng = random.Random(seed)
+    everything = [(pkg, name) for pkg in sorted(assets) for name in assets[pkg]]
+    moddir = os.path.join(root, "openkh", "mod")
+    for i, (pkg, name) in enumerate(rng.sample(everything, min(mod_files, len(everything)))):
+        fn = os.path.join(moddir, *name.split("/"))
+        if i % 4 == 3:
+            fn = os.path.join(moddir, "remastered", *name.split("/"), "-0.dds")
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        open(fn, "wb").write(rng.randbytes(file_size + rng.randint(1, 4096)))
+    patchdir = os.path.join(root, "patches")
+    os.makedirs(patchdir, exist_ok=True)
+    for p in range(patches):
+        with ZipFile(os.path.join(patchdir, "bench{:02d}.kh2pcpatch".format(p)), "w", ZIP_DEFLATED) as z:
+            for pkg, name in rng.sample(everything, min(patch_files, len(everything))):
+                z.writestr("{}/original/{}".format(pkg, name), rng.randbytes(file_size + rng.randint(1, 4096)))
+
+def makeOpenKh(root):
+    #the stand-in has to be found where build_from_mm looks for IdxImg
+    openkh = os.path.join(root, "openkh")
+    os.makedirs(openkh, exist_ok=True)
+    idxpath = os.path.join(openkh, "OpenKh.Command.IdxImg.exe")
+    if not os.path.exists(idxpath):
+        os.symlink(os.path.join(os.path.dirname(os.path.realpath(__file__)), "fake_idximg.py"), idxpath)
+    os.makedirs(os.path.join(root, "extracted"), exist_ok=True)
+
+def generate(root, gamename="kh2", assets_per_pkg=200, asset_size=64*1024, mod_files=100, patches=2, patch_files=100, seed=0):
+    assets = makeGame(root, gamename, assets_per_pkg, asset_size, seed=seed)
+    makeMods(root, assets, mod_files, patches, patch_files, asset_size, seed=seed+1)
+    makeOpenKh(root)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic game install and mods for benchmarking")
+    parser.add_argument("root")
+    parser.add_argument("-game", choices=list(games.keys()), default="kh2")
+    parser.add_argument("-assets", type=int, default=200, help="Assets per PKG")
+    parser.add_argument("-asset_size", type=int, default=64*1024, help="Bytes per asset and per mod file")
+    parser.add_argument("-mod_files", type=int, default=100, help="Files in the Mods Manager mod folder")
+    parser.add_argument("-patches", type=int, default=2, help="Number of .kh2pcpatch files")
+    parser.add_argument("-patch_files", type=int, default=100, help="Files per .kh2pcpatch")
+    parser.add_argument("-seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.root, args.game, args.assets, args.asset_size, args.mod_files, args.patches, args.patch_files, args.seed)
@@ -0,0 +1,125 @@
+# Runs build_from_mm end to end against a synthetic install (see generate.py) and the IdxImg stand-in,
+# one child process per mode, and appends wall time, bytes read/written and peak RSS to a results file
+import os, sys, json, time, argparse, subprocess, tempfile, shutil, resource
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+MODES = ["extract", "patch", "restore", "fast_patch", "fast_restore"]
+RESULTS_PATH = "bench_results.jsonl"
+RESULT_MARKER = "BENCH_RESULT "
+
+def readIo(text):
+    fields = dict(line.split(": ") for line in text.replace(" ", "\n").replace(":\n", ": ").splitlines() if ": " in line)
+    return int(fields.get("rchar", 0)), int(fields.get("wchar", 0))
+
+def child(root, mode, gamename, extra_args):
+    #runs inside the child process so resource usage is only this mode's
+    os.chdir(root)
+    import build_from_mm
+    build_from_mm.checksums.update(json.load(open("checksums.json")))
+    io_log = os.path.join(root, "idximg_io.log")
+    if os.path.exists(io_log):
+        os.remove(io_log)
+    os.environ["BENCH_IO_LOG"] = io_log
+    cli_args = [
+        "-game={}".format(gamename),
+        "-mode={}".format(mode),
+        "-openkh_path={}".format(os.path.join(root, "openkh")),
+        "-khgame_path={}".format(os.path.join(root, "game")),
+        "-extracted_games_path={}".format(os.path.join(root, "extracted")),
+        "-patches_path={}".format(os.path.join(root, "patches")),
+    ] + extra_args
+    starttime = time.time()
+    build_from_mm.main(cli_args=cli_args)
+    walltime = time.time() - starttime
+    read, written = readIo(open("/proc/self/io").read())
+    if os.path.exists(io_log):
+        for line in open(io_log):
+            r, w = readIo(line)
+            read += r
+            written += w
+    #ru_maxrss is in KiB on linux
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    print(RESULT_MARKER + json.dumps({"wall_time": round(walltime, 3), "bytes_read": read, "bytes_written": written, "peak_rss": peak_rss}))
+
+def runMode(root, mode, gamename, extra_args):
+    cmd = [sys.executable, os.path.realpath(__file__), "-child", root, "-mode", mode, "-game", gamename, "--"] + extra_args
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.stdout.decode("utf-8", "replace")
+    for line in output.splitlines():
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    print(output)
+    raise Exception("Benchmark of {} failed".format(mode))
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previousRun(results_path, params):
+    previous = None
+    if os.path.exists(results_path):
+        for line in open(results_path):
+            run = json.loads(line)
+            if run["params"] == params:
+                previous = run
+    return previous
+
+def printTable(results, previous):
+    print("{:<14}{:>10}{:>14}{:>14}{:>12}{:>10}".format("mode", "wall s", "read MB", "written MB", "rss MB", "vs prev"))
+    for mode, result in results.items():
+        change = ""
+        if previous and mode in previous["results"] and previous["results"][mode]["wall_time"]:
+            change = "{:+.0f}%".format((result["wall_time"] / previous["results"][mode]["wall_time"] - 1) * 100)
+        print("{:<14}{:>10.2f}{:>14.1f}{:>14.1f}{:>12.1f}{:>10}".format(
+            mode, result["wall_time"], result["bytes_read"] / 2**20, result["bytes_written"] / 2**20, result["peak_rss"] / 2**20, change))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark build_from_mm against a synthetic game install")
+    parser.add_argument("-child", help=argparse.SUPPRESS)
+    parser.add_argument("-mode", help=argparse.SUPPRESS)
+    parser.add_argument("-game", default="kh2")
+    parser.add_argument("-modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("-assets", type=int, default=200, help="Assets per PKG")
+    parser.add_argument("-asset_size", type=int, default=64*1024, help="Bytes per asset and per mod file")
+    parser.add_argument("-mod_files", type=int, default=100)
+    parser.add_argument("-patches", type=int, default=2)
+    parser.add_argument("-patch_files", type=int, default=100)
+    parser.add_argument("-workdir", help="Where to generate the synthetic install, a temporary folder by default")
+    parser.add_argument("-keep", action="store_true", default=False, help="Don't delete the workdir afterwards")
+    parser.add_argument("-results", default=RESULTS_PATH, help="File the results are appended to")
+    parser.add_argument("extra_args", nargs="*", help="Extra build_from_mm arguments, after --")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.mode, args.game, args.extra_args)
+        return
+
+    from generate import generate
+    root = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="mmbridge_bench_")
+    params = {
+        "game": args.game, "assets": args.assets, "asset_size": args.asset_size, "mod_files": args.mod_files,
+        "patches": args.patches, "patch_files": args.patch_files, "extra_args": args.extra_args
+    }
+    try:
+        print("Generating synthetic install in {}".format(root))
+        generate(root, args.game, args.assets, args.asset_size, args.mod_files, args.patches, args.patch_files)
+        results = {}
+        for mode in args.modes:
+            print("Running {}".format(mode))
+            results[mode] = runMode(root, mode, args.game, args.extra_args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    previous = previousRun(args.results, params)
+    printTable(results, previous)
+    with open(args.results, "a") as f:
+        f.write(json.dumps({"revision": revision(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "params": params, "results": results}) + "\n")
+
+if __name__ == "__main__":
+    main()
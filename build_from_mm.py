@@ -1,6 +1,6 @@
-import sys, os, shutil, subprocess, json, time, argparse
-from gooey import Gooey, GooeyParser
+import sys, os, shutil, subprocess, json, time, argparse, sqlite3
 from zipfile import ZipFile
+import hedfile
 
 # CLI usage example
 #In [1]: import build_from_mm
@@ -11,9 +11,7 @@ from zipfile import ZipFile
 # TODO bundle as one file
 # TODO support HD paths (DA: should be fine now)
 # TODO bundle the pkgmap.json and pkgmap_extras.json as resources in the executable
-# TODO add music only extract
 # TODO blacklist bad directory paths, hide most output and make obvious errors more obvious (try to bulletproof it for non technical people)
-# TODO make it a library
 # TODO make a pypi package
 
 VERBOSE_PRINTS = False
@@ -23,104 +21,95 @@ def print_debug(*args, **kwargs):
     if (not verbose) or (verbose and VERBOSE_PRINTS):
         print(''.join([str(s) for s in args]))
     
-class KingdomHearts1Patcher:
+class PathRule:
+    #a single path rewrite, only applied when the rewritten path isn't already part of the mod
+    def __init__(self, matches, rewrite):
+        self.matches = matches
+        self.rewrite = rewrite
+
+#only translate paths that aren't in the raw or remastred folders
+#this is because those paths are always only used for the PC port
+#(the check is an `or`, so in practice every path goes through the rules)
+KH2_PATH_RULES = [
+    PathRule(
+        lambda path: os.sep+"jp"+os.sep in path and not ".2ld" in path,
+        lambda path, region: path.replace(os.sep+"jp"+os.sep, os.sep+region+os.sep)
+    ),
+    PathRule(
+        lambda path: "ard" in path and path.count(os.sep) == 1,
+        lambda path, region: path.replace("ard"+os.sep, "ard"+os.sep+region+os.sep)
+    ),
+    #maps don't have region specifier for some reason, or they split it out into two files for some reason...
+    PathRule(
+        lambda path: "map" in path and path.count(os.sep) == 2,
+        lambda path, region: path.split("map")[0]+"map"+os.sep+path.split(os.sep)[-1]
+    ),
+    PathRule(
+        lambda path: path.endswith(".a.fm"),
+        lambda path, region: path.replace(".a.fm", ".a.{}".format(region))
+    ),
+]
+
+class Patcher:
+    path_rules = []
     def __init__(self, region):
         self.region = region
-        self.name = "kh1"
-        self.pkgs = ["kh1_first.pkg", "kh1_second.pkg", "kh1_third.pkg", "kh1_fourth.pkg", "kh1_fifth.pkg"]
-    def translate_path(self, path, moddir):
+    def _translate(self, path, exists):
         if path.startswith(os.sep):
             path = path[1:]
+        for rule in self.path_rules:
+            if rule.matches(path):
+                #check to see if the translated path already exists and ignore if it does
+                prepath = rule.rewrite(path, self.region)
+                if not exists(prepath):
+                    path = prepath
         return path
+    def translate_path(self, path, moddir):
+        return self._translate(path, lambda prepath: os.path.isfile(moddir+os.sep+prepath))
+    def translate_paths(self, paths, moddir):
+        #translates every path of a scanned mod at once, answering "does the PC version exist" from
+        #the scanned paths instead of one stat per file. paths are relative to moddir
+        existing = set(os.path.normcase(path.lstrip(os.sep)) for path in paths)
+        return {path: self._translate(path, lambda prepath: os.path.normcase(prepath) in existing) for path in paths}
     def translate_pkg_path(self, path):
         return path
 
-class KingdomHearts2Patcher:
+class KingdomHearts1Patcher(Patcher):
+    def __init__(self, region):
+        self.region = region
+        self.name = "kh1"
+        self.pkgs = ["kh1_first.pkg", "kh1_second.pkg", "kh1_third.pkg", "kh1_fourth.pkg", "kh1_fifth.pkg"]
+
+class KingdomHearts2Patcher(Patcher):
+    path_rules = KH2_PATH_RULES
     def __init__(self, region):
         self.region = region
         self.name = "kh2"
         self.pkgs = ["kh2_first.pkg", "kh2_second.pkg", "kh2_third.pkg", "kh2_fourth.pkg", "kh2_fifth.pkg", "kh2_sixth.pkg"]
-    def translate_path(self, path, moddir):
-        if path.startswith(os.sep):
-            path = path[1:]
-        #only translate paths that aren't in the raw or remastred folders
-        #this is because those paths are always only used for the PC port
-        if not path.startswith("remastered"+os.sep) or not path.startswith("raw"+os.sep):
-            if os.sep+"jp"+os.sep in path:
-                if not ".2ld" in path:
-                    #check to see if the translated path already exists and ignore if it does
-                    prepath = path.replace(os.sep+"jp"+os.sep, os.sep+self.region+os.sep)
-                    PCverExists = os.path.isfile(moddir+os.sep+prepath)
-                    if not PCverExists:
-                        path = prepath
-            if "ard" in path:
-                if path.count(os.sep) == 1:
-                    #check to see if the translated path already exists and ignore if it does
-                    prepath = path.replace("ard"+os.sep, "ard"+os.sep+self.region+os.sep)
-                    PCverExists = os.path.isfile(moddir+os.sep+prepath)
-                    if not PCverExists:
-                        path = prepath
-            if "map" in path:
-                if path.count(os.sep) == 2:
-                #maps don't have region specifier for some reason, or they split it out into two files for some reason...
-                    #check to see if the translated path already exists and ignore if it does
-                    prepath = path.split("map")[0]+"map"+os.sep+path.split(os.sep)[-1]
-                    PCverExists = os.path.isfile(moddir+os.sep+prepath)
-                    if not PCverExists:
-                        path = prepath
-            if path.endswith(".a.fm"):
-                #check to see if the translated path already exists and ignore if it does
-                prepath = path.replace(".a.fm", ".a.{}".format(self.region))
-                PCverExists = os.path.isfile(moddir+os.sep+prepath)
-                if not PCverExists:
-                    path = prepath
-        return path
-    def translate_pkg_path(self, path):
-        return path
 
-class BirthBySleepPatcher:
+class BirthBySleepPatcher(Patcher):
     def __init__(self, region):
         self.region = region
         self.name = "bbs"
         self.pkgs = ["bbs_first.pkg", "bbs_second.pkg", "bbs_third.pkg", "bbs_fourth.pkg"]
-    def translate_path(self, path, moddir):
-        if path.startswith(os.sep):
-            path = path[1:]
-        return path
-    def translate_pkg_path(self, path):
-        return path
-class KingdomHearts3DPatcher:
+class KingdomHearts3DPatcher(Patcher):
     def __init__(self, region):
         self.region = region
         self.name = "kh3d"
         self.pkgs = ["kh3d_first.pkg", "kh3d_second.pkg", "kh3d_third.pkg", "kh3d_fourth.pkg"]
-    def translate_path(self, path, moddir):
-        if path.startswith(os.sep):
-            path = path[1:]
-        return path
     def translate_pkg_path(self, path):
         return os.path.join(path, "..", "..", "..", "KH_2.8", "Image", "en")
 
-class RecomPatcher:
+class RecomPatcher(Patcher):
     def __init__(self, region):
         self.region = region
         self.name = "recom"
         self.pkgs = ["Recom.pkg"]
-    def translate_path(self, path, moddir):
-        if path.startswith(os.sep):
-            path = path[1:]
-        return path
-    def translate_pkg_path(self, path):
-        return path
-class MoviesPatcher:
+class MoviesPatcher(Patcher):
     def __init__(self, region):
         self.region = region
         self.name = "mare"
         self.pkgs = ["Mare.pkg"]
-    def translate_path(self, path, moddir):
-        if path.startswith(os.sep):
-            path = path[1:]
-        return path
     def translate_pkg_path(self, path):
         return os.path.join(path, "..")
 
@@ -193,24 +182,1789 @@ checksums = {
 }
 
 import hashlib 
+import threading
+import zlib
+import select, struct, ctypes, ctypes.util
+import fnmatch
+import re, collections, contextlib, bisect
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULTWORKERS = 4
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+PKGOUTPUT_DIR = "pkgoutput"
+EXTRACTOUTPUT_DIR = "extractedout"
+EXTRACT_PROGRESS_PATH = "extract_progress.json"
+BUILD_MANIFEST_PATH = "build_manifest.json"
+FICLONE = 0x40049409
+PKGMAP_INDEX_PATH = "pkgmap_index.sqlite"
+PKGMAP_INDEX_VERSION = 2 # bumped whenever the index's tables change, so old index files get rebuilt
+PKGMAP_PATH = "pkgmap.json"
+PKGMAP_EXTRAS_PATH = "pkgmap_extras.json" # predefined extras for patches that fail otherwise, such as GOA ROM
+PKGMAP_BLACKLIST_PATH = "pkgmap_blacklist.json" # blacklist of bad files to replace
+CHECKSUM_CACHE_PATH = "checksum_cache.json"
+RUN_REPORT_PATH = "run_report.json"
+WATCH_DEBOUNCE = 2.0 # seconds without changes before a Mods Manager build is considered finished
+WATCH_POLL_INTERVAL = 1.0
+BACKUP_DIR = "backup_pkgs" # flat backups made by older versions, only read to migrate them into the store
+BACKUP_STORE_DIR = "backup_store"
+BACKUP_CHUNK_SIZE = 4 * 1024 * 1024
+BACKUP_ASSET_CHUNK_SIZE = 256 * 1024 # assets at least this big get chunks of their own
+BACKUP_ASSET_GROUP = 8 # smaller ones share a chunk with, on average, this many others
+RESTORE_JOURNAL_PATH = "restore_journal.json"
+IDXIMG_PROGRESS_INTERVAL = 5.0 # seconds between progress lines for one IdxImg run
+IDXIMG_TAIL_LINES = 50 # lines of IdxImg output kept to show when it fails
+PATCH_PLAN_PATH = "patch_plan.json"
+RUN_PROFILE_PATH = "run_profile.prof"
+
+# which table a pkg/hed checksum was found in, in lookup order
+checksum_tables = [
+    ("current", checksums),
+    ("1.0.8", old_checksums),
+]
+
+class Phase:
+    def __init__(self, name, pkg=None, game=None):
+        self.name = name
+        self.pkg = pkg
+        self.game = game
+        self.wall_time = 0.0
+        self.files = 0
+        self.bytes = 0
+        self.subprocess_time = 0.0
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "game": self.game,
+            "pkg": self.pkg,
+            "wall_time": round(self.wall_time, 3),
+            "files": self.files,
+            "bytes": self.bytes,
+            "subprocess_time": round(self.subprocess_time, 3)
+        }
+
+class RunReport:
+    #wall time, files, bytes moved and subprocess time per phase of a run (and per pkg inside a phase).
+    #counts go to the innermost phase open on the calling thread, or on the thread that created the pool for
+    #pool workers. phases are tagged with the game the thread is working on when several games run at once
+    def __init__(self, profile=False):
+        self.starttime = time.time()
+        self.phases = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.main_stack = []
+        self.profiler = None
+        self.profiling = False
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+    def _stack(self):
+        if threading.current_thread() is threading.main_thread():
+            return self.main_stack
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+    def setGame(self, game):
+        self.local.game = game
+    def pool(self, workers):
+        #a thread pool whose workers count into the creating thread's phases and are tagged with its game
+        return ThreadPoolExecutor(max_workers=max(1, workers), initializer=self._adopt, initargs=(self._stack(), getattr(self.local, "game", None)))
+    def _adopt(self, parent, game):
+        self.local.parent = parent
+        self.local.game = game
+    def phase(self, name, pkg=None, profile=True):
+        return PhaseContext(self, Phase(name, pkg, getattr(self.local, "game", None)), profile)
+    def count(self, files=0, bytes=0, subprocess_time=0.0):
+        stack = self._stack() or getattr(self.local, "parent", None) or self.main_stack
+        if not stack:
+            return
+        with self.lock:
+            stack[-1].files += files
+            stack[-1].bytes += bytes
+            stack[-1].subprocess_time += subprocess_time
+    def summary(self):
+        lines = ["{:<24}{:<8}{:<16}{:>10}{:>8}{:>12}{:>14}".format("phase", "game", "pkg", "wall s", "files", "MB", "subprocess s")]
+        for phase in self.phases:
+            lines.append("{:<24}{:<8}{:<16}{:>10.2f}{:>8}{:>12.1f}{:>14.2f}".format(
+                phase.name, phase.game or "", phase.pkg or "", phase.wall_time, phase.files, phase.bytes / 2**20, phase.subprocess_time))
+        return "\n".join(lines)
+    def write(self, path=RUN_REPORT_PATH, **info):
+        report = dict(info)
+        report["total_time"] = round(time.time() - self.starttime, 3)
+        report["phases"] = [phase.to_dict() for phase in self.phases]
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1)
+        if self.profiler:
+            self.profiler.dump_stats(os.path.join(os.path.dirname(os.path.abspath(path)), RUN_PROFILE_PATH))
+
+class PhaseContext:
+    def __init__(self, report, phase, profile):
+        self.report = report
+        self.phase = phase
+        #only python side phases on the main thread are profiled, the rest is mostly waiting on IdxImg
+        self.profile = profile and report.profiler is not None and not report.profiling and threading.current_thread() is threading.main_thread()
+    def __enter__(self):
+        self.starttime = time.time()
+        self.report._stack().append(self.phase)
+        if self.profile:
+            self.report.profiling = True
+            self.report.profiler.enable()
+        return self.phase
+    def __exit__(self, *exc):
+        if self.profile:
+            self.report.profiler.disable()
+            self.report.profiling = False
+        self.report._stack().pop()
+        self.phase.wall_time = time.time() - self.starttime
+        with self.report.lock:
+            self.report.phases.append(self.phase)
+        return False
+
+_run_report = RunReport()
+
+def getRunReport():
+    return _run_report
 
-def validChecksum(path):
+def startRunReport(profile=False):
+    global _run_report
+    _run_report = RunReport(profile=profile)
+    return _run_report
+
+def limited(slots, fn):
+    #runs fn holding one of the shared job slots, so games running at the same time never go over -workers jobs
+    if slots is None:
+        return fn
+    def run(*args, **kwargs):
+        with slots:
+            return fn(*args, **kwargs)
+    return run
+
+def md5File(path):
+    #hash in fixed size chunks so multi-gigabyte pkgs are never fully read into memory
+    md5 = hashlib.md5()
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            md5.update(view[:n])
+    getRunReport().count(files=1, bytes=os.path.getsize(path))
+    return md5.hexdigest()
+
+def checksumVersion(pkgname, checksum):
+    for version, table in checksum_tables:
+        if table.get(pkgname) == checksum:
+            return version
+    return None
+
+class ChecksumCache:
+    #persistent md5 cache, an entry is only trusted while the file's size, mtime and inode are unchanged
+    def __init__(self, path=CHECKSUM_CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                self.entries = json.load(open(path))
+            except ValueError:
+                print_debug("WARNING: Checksum cache {} is corrupt, ignoring it".format(path))
+    def _fingerprint(self, path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+    def lookup(self, path):
+        entry = self.entries.get(os.path.abspath(path))
+        if entry and entry["stat"] == self._fingerprint(path):
+            return entry
+        return None
+    def entry(self, path):
+        entry = self.lookup(path)
+        if entry is None:
+            fingerprint = self._fingerprint(path)
+            checksum = md5File(path)
+            entry = {
+                "stat": fingerprint,
+                "md5": checksum,
+                "version": checksumVersion(os.path.basename(path), checksum)
+            }
+            with self.lock:
+                self.entries[os.path.abspath(path)] = entry
+                self.dirty = True
+        return entry
+    def record(self, path, checksum):
+        #store a checksum that was computed elsewhere, e.g. while the file was being written
+        entry = {
+            "stat": self._fingerprint(path),
+            "md5": checksum,
+            "version": checksumVersion(os.path.basename(path), checksum)
+        }
+        with self.lock:
+            self.entries[os.path.abspath(path)] = entry
+            self.dirty = True
+    def checksum(self, path):
+        return self.entry(path)["md5"]
+    def version(self, path):
+        return self.entry(path)["version"]
+    def checksum_many(self, paths, workers=DEFAULTWORKERS, slots=None):
+        #hashlib releases the GIL on large buffers, so threads hash several files at once
+        paths = [p for p in paths if os.path.exists(p)]
+        with getRunReport().pool(workers) as pool:
+            checksums = list(pool.map(limited(slots, self.checksum), paths))
+        self.save()
+        return dict(zip(paths, checksums))
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmpfn = self.path + ".tmp"
+            with open(tmpfn, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmpfn, self.path)
+            self.dirty = False
+
+_checksum_cache = None
+
+def getChecksumCache():
+    global _checksum_cache
+    if _checksum_cache is None:
+        _checksum_cache = ChecksumCache()
+    return _checksum_cache
+
+def validChecksum(path, cache=None):
     pkgname = path.split(os.sep)[-1]
     if pkgname not in checksums:
         raise Exception("Error: Checksum for {} not found!".format(pkgname))
-    checksum = hashlib.md5(open(path,'rb').read()).hexdigest()
-    if not checksum == checksums[pkgname]:
+    cache = cache or getChecksumCache()
+    entry = cache.entry(path)
+    cache.save()
+    if not entry["md5"] == checksums[pkgname]:
+        if entry["version"] is not None:
+            print_debug("PKG {} matches the {} checksums, not the current ones".format(pkgname, entry["version"]))
         print_debug("PKG {} has changed checksum!".format(pkgname))
         return False
     return True
 
-@Gooey(program_name="Mod Manager Bridge")
-def main_ui():
-    main()
+def normalizePkgmapKey(path):
+    #pkgmap keys are windows paths, mod paths use os.sep, so compare them with / and ignoring case
+    return path.replace("\\", "/").strip("/").lower()
+
+class GamePkgMap:
+    #one game's slice of the pkgmap index, with the extras merged in and the blacklist flagged.
+    #names maps the normalized paths back to the asset names as they are hashed in the heds
+    def __init__(self, pkgs, blacklist, names=None):
+        self.pkgs = pkgs
+        self.blacklist = blacklist
+        self.names = names or {}
+    def get(self, path, default=None):
+        return self.pkgs.get(normalizePkgmapKey(path), default)
+    def blacklisted(self, path):
+        return normalizePkgmapKey(path) in self.blacklist
+    def items(self):
+        return self.pkgs.items()
+    def name(self, path):
+        return self.names.get(normalizePkgmapKey(path), normalizePkgmapKey(path))
+
+def matchAssets(pkgmap, include=None, exclude=None):
+    #hed asset names of every pkgmap path matching one of the include globs and none of the exclude globs,
+    #as {pkg: set(names)}. globs can use / or \ and ignore case. remastered files are stored inside the
+    #asset named by the folders above them, so matching one selects that asset
+    include = [normalizePkgmapKey(pattern) for pattern in include or ["*"]]
+    exclude = [normalizePkgmapKey(pattern) for pattern in exclude or []]
+    assets = {}
+    for path, pkgs in pkgmap.items():
+        if not any(fnmatch.fnmatchcase(path, pattern) for pattern in include):
+            continue
+        if any(fnmatch.fnmatchcase(path, pattern) for pattern in exclude):
+            continue
+        name = pkgmap.name(path)
+        if name.lower().startswith("remastered/"):
+            name = name.split("/", 1)[1].rsplit("/", 1)[0]
+        for pkg in pkgs:
+            assets.setdefault(pkg, set()).add(name)
+    return assets
+
+def lookupPkgs(pkgmap, relfn_trans):
+    #raw paths are the exact same as original paths, just with the root flder being "raw" instead of "original"
+    #so we can check against the original path instead of needing to update the pkgmap.
+    if "raw"+os.sep in relfn_trans:
+        return pkgmap.get(relfn_trans.replace("raw"+os.sep, ""), "")
+    return pkgmap.get(relfn_trans, "")
+
+class PkgMapIndex:
+    #pkgmap.json, pkgmap_extras.json and pkgmap_blacklist.json compiled into one sqlite file,
+    #rebuilt only when one of the json files changes
+    def __init__(self, path=PKGMAP_INDEX_PATH, pkgmap=PKGMAP_PATH, extras=PKGMAP_EXTRAS_PATH, blacklist=PKGMAP_BLACKLIST_PATH):
+        self.path = path
+        self.sources = [pkgmap, extras, blacklist]
+    def _stamp(self):
+        stamp = []
+        for source in self.sources:
+            if os.path.exists(source):
+                st = os.stat(source)
+                stamp.append([source, st.st_size, st.st_mtime_ns])
+        return json.dumps([PKGMAP_INDEX_VERSION, stamp])
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS pkgmap (game TEXT, path TEXT, name TEXT, pkgs TEXT, blacklisted INTEGER, PRIMARY KEY (game, path))")
+        return db
+    def build(self, db):
+        pkgmap_path, extras_path, blacklist_path = self.sources
+        if not os.path.exists(pkgmap_path):
+            raise Exception("{} not found".format(pkgmap_path))
+        print_debug("Building pkgmap index", verbose=True)
+        pkgmap = json.load(open(pkgmap_path))
+        extras = json.load(open(extras_path)) if os.path.exists(extras_path) else {}
+        blacklist = json.load(open(blacklist_path)) if os.path.exists(blacklist_path) else {}
+        rows = []
+        for gamename in set(pkgmap) | set(extras) | set(blacklist):
+            entries = {}
+            names = {}
+            for path, pkgs in list(pkgmap.get(gamename, {}).items()) + list(extras.get(gamename, {}).items()):
+                entries[normalizePkgmapKey(path)] = pkgs
+                names[normalizePkgmapKey(path)] = path.replace("\\", "/").strip("/")
+            blacklisted = set(normalizePkgmapKey(path) for path in blacklist.get(gamename, {}))
+            for path in blacklisted:
+                entries.setdefault(path, [])
+            for path, pkgs in entries.items():
+                rows.append((gamename, path, names.get(path, path), ",".join(pkgs), 1 if path in blacklisted else 0))
+        with db:
+            #the table is recreated in case it was made by an older version with different columns
+            db.execute("DROP TABLE IF EXISTS pkgmap")
+            db.execute("CREATE TABLE pkgmap (game TEXT, path TEXT, name TEXT, pkgs TEXT, blacklisted INTEGER, PRIMARY KEY (game, path))")
+            db.executemany("INSERT INTO pkgmap VALUES (?, ?, ?, ?, ?)", rows)
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('sources', ?)", (self._stamp(),))
+    def load(self, gamename):
+        db = self._connect()
+        try:
+            stamp = db.execute("SELECT value FROM meta WHERE name = 'sources'").fetchone()
+            if stamp is None or stamp[0] != self._stamp():
+                self.build(db)
+            pkgs = {}
+            blacklist = set()
+            names = {}
+            for path, name, pkglist, blacklisted in db.execute("SELECT path, name, pkgs, blacklisted FROM pkgmap WHERE game = ?", (gamename,)):
+                if pkglist:
+                    pkgs[path] = pkglist.split(",")
+                if blacklisted:
+                    blacklist.add(path)
+                if name != path:
+                    names[path] = name
+            return GamePkgMap(pkgs, blacklist, names)
+        finally:
+            db.close()
+
+def cloneFile(src, dst):
+    #copy-on-write clone (reflink), only supported on filesystems like btrfs and xfs
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copymode(src, dst)
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+def stageFile(src, dst):
+    #khbuild is only ever read by IdxImg, so a hardlink or clone of the mod file is as good as a copy
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        getRunReport().count(files=1)
+        return
+    except OSError:
+        pass
+    if not cloneFile(src, dst):
+        shutil.copy(src, dst)
+        getRunReport().count(bytes=os.path.getsize(dst))
+    getRunReport().count(files=1)
+
+def installFile(src, dst, move=False):
+    #dst is never written in place, the new file is built next to it and renamed over it
+    #so a crash leaves either the old or the new file, never a torn one
+    if move:
+        try:
+            os.replace(src, dst)
+            getRunReport().count(files=1)
+            return
+        except OSError:
+            pass # different filesystem, fall back to copying
+    tmpfn = dst + ".tmp"
+    if not cloneFile(src, tmpfn):
+        shutil.copy(src, tmpfn)
+        getRunReport().count(bytes=os.path.getsize(tmpfn))
+    os.replace(tmpfn, dst)
+    getRunReport().count(files=1)
+    if move:
+        os.remove(src)
+
+def scratchDir(name, targetdir):
+    #IdxImg output has to be on the same filesystem as where it ends up so moving it there is a rename
+    outputroot = os.path.abspath(name)
+    if not os.path.exists(outputroot):
+        os.makedirs(outputroot)
+    if os.stat(outputroot).st_dev != os.stat(targetdir).st_dev:
+        outputroot = os.path.join(targetdir, name)
+    return outputroot
+
+def pkgOutputDir(pkgdir):
+    return scratchDir(PKGOUTPUT_DIR, pkgdir)
+
+def mergeTree(src, dst):
+    #moves everything in src into dst with renames, whole folders at once when dst doesn't have them yet
+    if not os.path.exists(dst):
+        parent = os.path.dirname(dst)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+        shutil.move(src, dst)
+        return
+    for name in os.listdir(src):
+        if os.path.isdir(os.path.join(src, name)):
+            mergeTree(os.path.join(src, name), os.path.join(dst, name))
+        else:
+            installFile(os.path.join(src, name), os.path.join(dst, name), move=True)
+    os.rmdir(src)
+
+def linkPkg(pkgfile, dst):
+    #IdxImg is pointed at a filtered hed next to the original pkg, which is only ever read
+    try:
+        os.link(pkgfile, dst)
+    except OSError:
+        os.symlink(os.path.abspath(pkgfile), dst)
+
+def extractFiltered(idxpath, hedfn, names, outputdir, timeout=None):
+    #extracts only the named assets by running IdxImg on a hed that lists just those. the filtered hed's folder
+    #is on the pkg's filesystem, like patchDelta's, so the pkg can be hardlinked into it
+    basedir = os.path.join(pkgOutputDir(os.path.dirname(os.path.abspath(hedfn))), hedfile.pkgName(hedfn) + "_extractbase")
+    if os.path.exists(basedir):
+        shutil.rmtree(basedir)
+    os.makedirs(basedir)
+    basehed = os.path.join(basedir, os.path.basename(hedfn))
+    linkPkg(hedfn[:-4]+".pkg", basehed[:-4]+".pkg")
+    hedfile.filterHed(hedfn, basehed, set(hedfile.nameHash(name) for name in names))
+    try:
+        return runExtract(idxpath, basehed, outputdir, timeout=timeout)
+    finally:
+        shutil.rmtree(basedir)
 
-def main(cli_args: list = []):
+_idximg_running = set()
+_idximg_lock = threading.Lock()
+_idximg_cancelled = threading.Event()
+IDXIMG_PROGRESS = re.compile(r"\[(\d+)/(\d+)\]")
+
+def cancelIdxImg():
+    #kills every running IdxImg and makes the ones still waiting to start fail straight away
+    _idximg_cancelled.set()
+    with _idximg_lock:
+        for proc in _idximg_running:
+            proc.kill()
+
+def runIdxImg(args, label, timeout=None, total=None):
+    #streams IdxImg's output instead of collecting it: every line goes to the verbose log, progress is shown
+    #with an ETA every few seconds, and only the last lines are kept to be shown if it fails. progress comes
+    #from "[i/total]" lines, or else from the number of lines so far against total, the hed's entry count, as
+    #IdxImg prints a line per asset. the process is killed when it runs over timeout seconds or cancelIdxImg is called
+    if _idximg_cancelled.is_set():
+        raise Exception("{} cancelled".format(label))
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    with _idximg_lock:
+        _idximg_running.add(proc)
+    timedout = threading.Event()
+    def kill():
+        timedout.set()
+        proc.kill()
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+        timer.daemon = True
+        timer.start()
     starttime = time.time()
+    lastprogress = starttime
+    tail = collections.deque(maxlen=IDXIMG_TAIL_LINES)
+    lines = 0
+    try:
+        for line in proc.stdout:
+            line = line.decode("utf-8", "replace").rstrip()
+            tail.append(line)
+            print_debug(line, verbose=True)
+            lines += 1
+            progress = IDXIMG_PROGRESS.search(line)
+            if progress:
+                done, count = int(progress.group(1)), int(progress.group(2))
+            elif total:
+                done, count = min(lines, total), total
+            else:
+                continue
+            if done and time.time() - lastprogress >= IDXIMG_PROGRESS_INTERVAL:
+                lastprogress = time.time()
+                eta = (lastprogress - starttime) / done * (count - done)
+                print_debug("{}: {}/{} ({}%), about {}s left".format(label, done, count, done * 100 // max(count, 1), round(eta)))
+        proc.wait()
+    finally:
+        if timer:
+            timer.cancel()
+        if proc.poll() is None:
+            #interrupted while reading, don't leave IdxImg running
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        with _idximg_lock:
+            _idximg_running.discard(proc)
+        getRunReport().count(subprocess_time=time.time()-starttime)
+    if timedout.is_set():
+        raise Exception("{} timed out after {}s".format(label, timeout))
+    if _idximg_cancelled.is_set():
+        raise Exception("{} cancelled".format(label))
+    if proc.returncode != 0:
+        print_debug("\n".join(tail))
+        raise Exception("{} failed".format(label))
+
+def hedEntries(hedfn):
+    try:
+        return os.path.getsize(hedfn) // hedfile.HED_ENTRY.size
+    except OSError:
+        return None
+
+@contextlib.contextmanager
+def idxImgPool(workers):
+    #a report pool that kills the running IdxImg jobs on ctrl+c, rather than waiting for them to finish
+    with getRunReport().pool(workers) as pool:
+        try:
+            yield pool
+        except KeyboardInterrupt:
+            print_debug("Cancelling")
+            cancelIdxImg()
+            raise
+
+def runExtract(idxpath, hedfn, outputdir, timeout=None):
+    if os.path.exists(outputdir):
+        shutil.rmtree(outputdir)
+    idx_args = [idxpath, "hed", "extract", hedfn, "-o", outputdir]
+    print_debug(idxpath, "hed", "extract", '"{}"'.format(hedfn), "-o", '"{}"'.format(outputdir))
+    with getRunReport().phase("idximg extract", pkg=hedfn.split(os.sep)[-1][:-4], profile=False):
+        try:
+            runIdxImg(idx_args, "Extract of {}".format(os.path.basename(hedfn)), timeout=timeout, total=hedEntries(hedfn))
+        except BaseException:
+            #a partial extraction is never merged
+            shutil.rmtree(outputdir, ignore_errors=True)
+            raise
+    return outputdir
+
+_extract_progress_lock = threading.Lock()
+
+def extractHeds(idxpath, heds, extracted_game_path, workers=DEFAULTWORKERS, validate_checksum=False, resume=False, slots=None, assets=None, filterkey=None, timeout=None):
+    #every hed is extracted into its own folder, concurrently with hashing its pkg, and merged into
+    #extracted_game_path as soon as it's done. extract_progress.json remembers the merged heds so an
+    #interrupted extraction can be resumed. assets ({pkg: names}) limits each hed to those assets,
+    #such an extraction is merged over what's already there and is remembered under its filterkey,
+    #so running the same filter again only redoes pkgs that changed
+    progress = {}
+    if os.path.exists(EXTRACT_PROGRESS_PATH):
+        progress = json.load(open(EXTRACT_PROGRESS_PATH))
+    basekey = os.path.abspath(extracted_game_path)
+    progresskey = basekey
+    if filterkey:
+        progresskey += "|" + filterkey
+    if not os.path.exists(extracted_game_path) or (not resume and assets is None):
+        #nothing of what was recorded for this folder is left, with or without filters
+        if os.path.exists(extracted_game_path):
+            shutil.rmtree(extracted_game_path)
+        with _extract_progress_lock:
+            current = json.load(open(EXTRACT_PROGRESS_PATH)) if os.path.exists(EXTRACT_PROGRESS_PATH) else {}
+            stale = [key for key in current if key == basekey or key.startswith(basekey + "|")]
+            if stale:
+                for key in stale:
+                    current.pop(key)
+                with open(EXTRACT_PROGRESS_PATH + ".tmp", "w") as f:
+                    json.dump(current, f)
+                os.replace(EXTRACT_PROGRESS_PATH + ".tmp", EXTRACT_PROGRESS_PATH)
+        progress = {}
+    done = progress.setdefault(progresskey, {})
+    def saveProgress():
+        #other games may be extracting at the same time, only this game's entry is replaced
+        with _extract_progress_lock:
+            current = json.load(open(EXTRACT_PROGRESS_PATH)) if os.path.exists(EXTRACT_PROGRESS_PATH) else {}
+            current[progresskey] = done
+            with open(EXTRACT_PROGRESS_PATH + ".tmp", "w") as f:
+                json.dump(current, f)
+            os.replace(EXTRACT_PROGRESS_PATH + ".tmp", EXTRACT_PROGRESS_PATH)
+    cache = getChecksumCache()
+    parent = os.path.dirname(os.path.abspath(extracted_game_path))
+    outputroot = scratchDir(EXTRACTOUTPUT_DIR, parent)
+    with idxImgPool(workers) as pool:
+        checksums = {}
+        jobs = {}
+        for hedfn in heds:
+            hedname = os.path.basename(hedfn)
+            pkgfile = hedfn[:-4]+".pkg"
+            if hedname in done and done[hedname] == cache.checksum(pkgfile):
+                print_debug("{} was already extracted, skipping it".format(hedname))
+                continue
+            checksums[hedname] = pool.submit(limited(slots, validChecksum), pkgfile)
+            if assets is not None:
+                job = pool.submit(limited(slots, extractFiltered), idxpath, hedfn, assets[hedname[:-4]], os.path.join(outputroot, hedname[:-4]), timeout=timeout)
+            else:
+                job = pool.submit(limited(slots, runExtract), idxpath, hedfn, os.path.join(outputroot, hedname[:-4]), timeout=timeout)
+            jobs[job] = hedfn
+        for job in as_completed(jobs):
+            hedfn = jobs[job]
+            hedname = os.path.basename(hedfn)
+            outputdir = job.result()
+            if not checksums[hedname].result() and validate_checksum:
+                shutil.rmtree(outputdir)
+                raise Exception("Error: {} has an invalid checksum, please restore the original file!".format(hedfn))
+            with getRunReport().phase("merge", pkg=hedname[:-4]):
+                if os.path.exists(os.path.join(outputdir, "original")):
+                    mergeTree(os.path.join(outputdir, "original"), extracted_game_path)
+                if os.path.exists(os.path.join(outputdir, "remastered")):
+                    mergeTree(os.path.join(outputdir, "remastered"), os.path.join(extracted_game_path, "remastered"))
+                shutil.rmtree(outputdir)
+            done[hedname] = cache.checksum(hedfn[:-4]+".pkg")
+            saveProgress()
+            print_debug("Extracted: {}".format(hedname))
+    cache.save()
+
+def fastPatchName(name, gamename):
+    #extract all kh2pcpatch files to the first PKG if fast_patch is used.
+    if gamename != "Recom" or gamename != "Movies":
+        if "/original/" in name:
+            return gamename+"_first/original/"+name.split("/original/")[1]
+        elif "/remastered/" in name:
+            return gamename+"_first/remastered/"+name.split("/remastered/")[1]
+        elif "/raw/" in name:
+            return gamename+"_first/raw/"+name.split("/raw/")[1]
+    return name
+
+def indexPatches(patches, gamename, fastpatch=False):
+    #resolves which kh2pcpatch member ends up at each khbuild path without reading any data,
+    #patches are applied in order so a later patch wins over an earlier one
+    index = {} # khbuild relative path -> (patch filename, ZipInfo)
+    for patch in patches:
+        with ZipFile(patch) as input_zip:
+            for info in input_zip.infolist():
+                if info.is_dir() or info.file_size == 0:
+                    continue
+                name = fastPatchName(info.filename, gamename) if fastpatch else info.filename
+                index[os.path.normpath(name)] = (patch, info)
+    return index
+
+def extractPatchFile(patch, members, buildpath):
+    #members is a list of (ZipInfo, khbuild relative path), copied one buffer at a time
+    with ZipFile(patch) as input_zip:
+        for info, newfn in members:
+            newfn = os.path.join(buildpath, newfn)
+            new_basedir = os.path.dirname(newfn)
+            if not os.path.exists(new_basedir):
+                os.makedirs(new_basedir, exist_ok=True)
+            #khbuild files can be hardlinks to the mod files, replace rather than write through them
+            if os.path.lexists(newfn):
+                os.remove(newfn)
+            with input_zip.open(info) as src, open(newfn, "xb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            getRunReport().count(files=1, bytes=info.file_size)
+
+def extractPatches(members, buildpath, workers=DEFAULTWORKERS):
+    #members is a dict of khbuild relative path -> (patch filename, ZipInfo), one worker per archive
+    byPatch = {}
+    for newfn, (patch, info) in members.items():
+        byPatch.setdefault(patch, []).append((info, newfn))
+    with getRunReport().pool(workers) as pool:
+        for job in [pool.submit(extractPatchFile, patch, files, buildpath) for patch, files in byPatch.items()]:
+            job.result()
+
+def inputsDigest(inputs):
+    #inputs is a dict of khbuild relative path -> content hash of the file staged there
+    md5 = hashlib.md5()
+    for relpath in sorted(inputs):
+        md5.update("{}\0{}\n".format(relpath.replace(os.sep, "/"), inputs[relpath]).encode("utf-8"))
+    return md5.hexdigest()
+
+def statFingerprint(path):
+    st = os.stat(path)
+    return "stat:{}:{}:{}".format(st.st_size, st.st_mtime_ns, st.st_ino)
+
+def pkgFingerprint(path, recorded, cache):
+    #append patched pkgs are identified by their stat, so checking them never reads the whole pkg
+    if recorded and recorded.startswith("stat:"):
+        return statFingerprint(path)
+    return cache.checksum(path)
+
+class BackupStore:
+    #content addressed backups: files are split into chunks that are stored once, by sha256, so data shared
+    #between pkg versions and installs is only kept once. pkgs are cut where their assets start, so an asset
+    #that moved to another offset in a newer pkg version still makes the same chunks. each backed up file is a list of
+    #chunks named by the file's md5, and index.json says which md5 is the backup of which file per install
+    def __init__(self, path=BACKUP_STORE_DIR, compress=False):
+        self.path = path
+        self.compress = compress
+        self.lock = threading.Lock()
+        #the folders are only made once something is backed up
+        self.index = {}
+        if os.path.exists(os.path.join(path, "index.json")):
+            self.index = json.load(open(os.path.join(path, "index.json")))
+    def _chunkPath(self, digest):
+        return os.path.join(self.path, "chunks", digest[:2], digest)
+    def _writeChunk(self, digest, data):
+        chunkfn = self._chunkPath(digest)
+        if os.path.exists(chunkfn) or os.path.exists(chunkfn + ".z"):
+            return
+        if self.compress:
+            compressed = zlib.compress(data, 1)
+            if len(compressed) < len(data):
+                data = compressed
+                chunkfn += ".z"
+        os.makedirs(os.path.dirname(chunkfn), exist_ok=True)
+        tmpfn = "{}.{}.tmp".format(chunkfn, threading.get_ident())
+        with open(tmpfn, "wb") as f:
+            f.write(data)
+        os.replace(tmpfn, chunkfn)
+        getRunReport().count(bytes=len(data))
+    def _readChunk(self, digest):
+        chunkfn = self._chunkPath(digest)
+        if os.path.exists(chunkfn):
+            return open(chunkfn, "rb").read()
+        if os.path.exists(chunkfn + ".z"):
+            return zlib.decompress(open(chunkfn + ".z", "rb").read())
+        raise Exception("Backup chunk {} is missing".format(digest))
+    def _recipePath(self, checksum):
+        return os.path.join(self.path, "files", checksum + ".json")
+    def backupFile(self, src, boundaries=None):
+        #stores src and returns its md5, which is computed from the same read so no separate hashing pass is needed.
+        #chunks end at each of boundaries (sorted offsets) and are never longer than BACKUP_CHUNK_SIZE
+        boundaries = boundaries or []
+        md5 = hashlib.md5()
+        chunks = []
+        size = 0
+        with open(src, "rb") as f:
+            while True:
+                end = size + BACKUP_CHUNK_SIZE
+                i = bisect.bisect_right(boundaries, size)
+                if i < len(boundaries):
+                    end = min(end, boundaries[i])
+                data = f.read(end - size)
+                if not data:
+                    break
+                md5.update(data)
+                digest = hashlib.sha256(data).hexdigest()
+                self._writeChunk(digest, data)
+                chunks.append(digest)
+                size += len(data)
+        checksum = md5.hexdigest()
+        if not os.path.exists(self._recipePath(checksum)):
+            os.makedirs(os.path.dirname(self._recipePath(checksum)), exist_ok=True)
+            tmpfn = "{}.{}.tmp".format(self._recipePath(checksum), threading.get_ident())
+            with open(tmpfn, "w") as f:
+                json.dump({"size": size, "chunks": chunks}, f)
+            os.replace(tmpfn, self._recipePath(checksum))
+        getRunReport().count(files=1)
+        return checksum
+    def add(self, pkgdir, name, checksum):
+        with self.lock:
+            self.index.setdefault(os.path.abspath(pkgdir), {})[name] = checksum
+            self.save()
+    def lookup(self, pkgdir, name):
+        checksum = self.index.get(os.path.abspath(pkgdir), {}).get(name)
+        if checksum and os.path.exists(self._recipePath(checksum)):
+            return checksum
+        return None
+    def find(self, name):
+        #a backup of an original version of name, made for any install. recipes are named by md5 so one made
+        #before the install was moved, or for the same path spelled differently, is still found
+        for version, table in checksum_tables:
+            if name in table and os.path.exists(self._recipePath(table[name])):
+                return table[name]
+        return None
+    def size(self, checksum):
+        return json.load(open(self._recipePath(checksum)))["size"]
+    def restoreFile(self, checksum, dst):
+        #rebuilds the file next to dst, checking its md5 on the way, and renames it over dst
+        recipe = json.load(open(self._recipePath(checksum)))
+        md5 = hashlib.md5()
+        tmpfn = dst + ".tmp"
+        with open(tmpfn, "wb") as f:
+            for digest in recipe["chunks"]:
+                data = self._readChunk(digest)
+                md5.update(data)
+                f.write(data)
+        if md5.hexdigest() != checksum:
+            os.remove(tmpfn)
+            raise Exception("Error: the backup of {} is corrupt".format(os.path.basename(dst)))
+        os.replace(tmpfn, dst)
+        getRunReport().count(files=1, bytes=recipe["size"])
+    def save(self):
+        indexfn = os.path.join(self.path, "index.json")
+        os.makedirs(self.path, exist_ok=True)
+        with open(indexfn + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(indexfn + ".tmp", indexfn)
+
+def assetBoundaries(entries):
+    #where to cut a pkg's backup into chunks. big assets get chunks of their own and small ones are grouped,
+    #a group ending before each asset picked by its name hash. neither depends on where an asset is in the
+    #pkg, so assets that didn't change between pkg versions make the same chunks even when they moved
+    boundaries = set()
+    for entry in entries:
+        if entry.data_length >= BACKUP_ASSET_CHUNK_SIZE:
+            boundaries.update([entry.offset, entry.offset + entry.data_length])
+        elif entry.name[0] % BACKUP_ASSET_GROUP == 0:
+            boundaries.add(entry.offset)
+    return sorted(boundaries)
+
+def backupPkg(store, pkgdir, pkg):
+    #backs up a pkg and its hed into the store, only if they match one of the checksums tables. a file that
+    #doesn't may already be patched, it's never stored as an original, an existing backup of it is used instead.
+    #flat backups from older versions are migrated instead of backing up the (possibly patched) game files
+    cache = getChecksumCache()
+    for name in [pkg, pkg.split(".pkg")[0]+".hed"]:
+        if store.lookup(pkgdir, name):
+            continue
+        sourcefn = os.path.join(pkgdir, name)
+        if os.path.exists(os.path.join(BACKUP_DIR, name)):
+            sourcefn = os.path.join(BACKUP_DIR, name)
+        if cache.version(sourcefn) is None:
+            checksum = store.find(name)
+            if checksum is None:
+                raise Exception("Error: {} has an invalid checksum and there's no backup of the original, please restore the original file and try again".format(sourcefn))
+            print_debug("PKG {} has changed checksum, using the existing backup of the original".format(name))
+            store.add(pkgdir, name, checksum)
+            continue
+        print_debug("Backing up file: " + sourcefn)
+        boundaries = None
+        if name == pkg:
+            try:
+                boundaries = assetBoundaries(hedfile.readHed(sourcefn.split(".pkg")[0]+".hed"))
+            except Exception:
+                pass #without a readable hed the pkg is cut into fixed size chunks
+        store.add(pkgdir, name, store.backupFile(sourcefn, boundaries))
+
+def restorePkg(store, pkgdir, pkg, entry=None):
+    #entry is the pkg's restore journal entry. a pkg that was append patched, and hasn't changed since, or whose
+    #append was interrupted, only needs the appended assets cut off again. the pkg is truncated before the hed
+    #is restored so an interrupted restore never looks like an original
+    pkgfile = os.path.join(pkgdir, pkg)
+    hedname = pkg.split(".pkg")[0]+".hed"
+    pkgsum = store.lookup(pkgdir, pkg) or store.find(pkg)
+    hedsum = store.lookup(pkgdir, hedname) or store.find(hedname)
+    if pkgsum is None or hedsum is None:
+        raise Exception("No backup of {} found".format(pkg))
+    for name, checksum in [(pkg, pkgsum), (hedname, hedsum)]:
+        if checksum != checksums.get(name):
+            print_debug("WARNING: the backup of {} doesn't match the original game's checksum".format(name))
+    appended = entry and entry.get("base_size") is not None and store.size(pkgsum) == entry["base_size"]
+    if appended and entry["state"] == "pending":
+        appended = os.path.getsize(pkgfile) >= entry["base_size"]
+    elif appended:
+        appended = statFingerprint(pkgfile) == entry["post"][".pkg"]
+    if appended:
+        hedfile.truncatePkg(pkgfile, entry["base_size"])
+        getRunReport().count(files=1)
+    else:
+        store.restoreFile(pkgsum, pkgfile)
+        getChecksumCache().record(pkgfile, pkgsum)
+    store.restoreFile(hedsum, os.path.join(pkgdir, hedname))
+    getChecksumCache().record(os.path.join(pkgdir, hedname), hedsum)
+
+def restorePkgs(store, pkgdir, pkgs, workers=DEFAULTWORKERS, onRestored=None, slots=None):
+    #pkgs is {pkg filename: restore journal entry or None}. pkgs are restored concurrently, each file being
+    #checked against its md5 as it's rebuilt, and onRestored(pkg) is called as each one finishes
+    failed = []
+    with getRunReport().pool(workers) as pool:
+        jobs = {}
+        for pkg, entry in pkgs.items():
+            print("Restoring {}".format(pkg))
+            jobs[pool.submit(limited(slots, restorePkg), store, pkgdir, pkg, entry)] = pkg
+        for job in as_completed(jobs):
+            pkg = jobs[job]
+            try:
+                job.result()
+            except Exception as err:
+                print_debug("ERROR: {}".format(err))
+                failed.append(pkg)
+                continue
+            if onRestored:
+                onRestored(pkg)
+    if failed:
+        raise Exception("Restore failed for {}".format(", ".join(sorted(failed))))
+
+class RestoreJournal:
+    #records which pkg/hed pairs the patch phase replaces in the game folder, so restore only has to look at those.
+    #an entry is written as pending, with the fingerprints of the files being replaced, before anything is copied
+    #back and marked committed, with the new fingerprints, once both files are in place. fingerprints are stat
+    #based so neither patching nor restoring needs to read the files
+    def __init__(self, path=RESTORE_JOURNAL_PATH):
+        self.path = path
+        #save takes it too, begin/commit/remove save while already holding it
+        self.lock = threading.RLock()
+        self.entries = {}
+        #{pkgdir: [pkg names]} restore has checksummed once. until then there's no telling whether an older
+        #version patched the pkg, so restore falls back to checksumming it
+        self.checked = {}
+        if os.path.exists(path):
+            try:
+                data = json.load(open(path))
+                self.entries = data.get("pkgs", {})
+                self.checked = data.get("scanned", {})
+            except (ValueError, AttributeError):
+                print_debug("WARNING: Restore journal {} is corrupt, ignoring it".format(path))
+    def _fingerprints(self, pkgdir, pkg):
+        return {ext: statFingerprint(os.path.join(pkgdir, pkg+ext)) for ext in [".pkg", ".hed"]}
+    def pkgs(self, pkgdir):
+        with self.lock:
+            return dict(self.entries.get(os.path.abspath(pkgdir), {}))
+    def begin(self, pkgdir, pkg, base_size=None):
+        with self.lock:
+            entry = self.entries.setdefault(os.path.abspath(pkgdir), {}).get(pkg)
+            if entry is not None:
+                #patching over an already patched pkg, the originals are whatever the first entry recorded
+                entry["state"] = "pending"
+                entry["base_size"] = base_size if entry["base_size"] is None else entry["base_size"]
+            else:
+                self.entries[os.path.abspath(pkgdir)][pkg] = {"state": "pending", "pre": self._fingerprints(pkgdir, pkg), "post": None, "base_size": base_size}
+            self.save()
+    def commit(self, pkgdir, pkg):
+        with self.lock:
+            entry = self.entries[os.path.abspath(pkgdir)][pkg]
+            entry["state"] = "committed"
+            entry["post"] = self._fingerprints(pkgdir, pkg)
+            self.save()
+    def adopt(self, pkgdir, pkg, base_size=None):
+        #journals a pkg patched before there was a journal, what it replaced isn't known so it always gets restored
+        with self.lock:
+            self.entries.setdefault(os.path.abspath(pkgdir), {})[pkg] = {"state": "committed", "pre": None, "post": self._fingerprints(pkgdir, pkg), "base_size": base_size}
+    def scanned(self, pkgdir, pkg):
+        with self.lock:
+            return pkg in self.checked.get(os.path.abspath(pkgdir), [])
+    def setScanned(self, pkgdir, pkgs):
+        with self.lock:
+            scanned = self.checked.setdefault(os.path.abspath(pkgdir), [])
+            scanned += [pkg for pkg in pkgs if pkg not in scanned]
+            self.save()
+    def untouched(self, pkgdir, pkg):
+        #true when the pkg/hed in the game folder are still the ones that were there before patching
+        return self._fingerprints(pkgdir, pkg) == self.entries[os.path.abspath(pkgdir)][pkg]["pre"]
+    def remove(self, pkgdir, pkg):
+        with self.lock:
+            if self.entries.get(os.path.abspath(pkgdir), {}).pop(pkg, None) is not None:
+                self.save()
+    def save(self):
+        with self.lock:
+            tmpfn = self.path + ".tmp"
+            with open(tmpfn, "w") as f:
+                json.dump({"pkgs": self.entries, "scanned": self.checked}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpfn, self.path)
+
+class BuildManifest:
+    #remembers, per game and pkg, which staged inputs produced the pkg/hed currently in the game folder
+    def __init__(self, path=BUILD_MANIFEST_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                self.entries = json.load(open(path))
+            except ValueError:
+                print_debug("WARNING: Build manifest {} is corrupt, ignoring it".format(path))
+    def get(self, gamename, pkg):
+        return self.entries.get(gamename, {}).get(pkg)
+    def set(self, gamename, pkg, inputs, pkgsum, hedsum, base_size=None):
+        #base_size is set when the pkg was patched by appending to the original, pkgsum is then a stat fingerprint
+        with self.lock:
+            self.entries.setdefault(gamename, {})[pkg] = {"inputs": inputs, "pkg": pkgsum, "hed": hedsum, "base_size": base_size}
+            self.save()
+    def remove(self, gamename, pkg):
+        with self.lock:
+            if self.entries.get(gamename, {}).pop(pkg, None) is not None:
+                self.save()
+    def upToDate(self, gamename, pkg, inputs, pkgdir, cache):
+        entry = self.get(gamename, pkg)
+        if entry is None or entry["inputs"] != inputs:
+            return False
+        pkgfile = os.path.join(pkgdir, pkg+".pkg")
+        hedfile = os.path.join(pkgdir, pkg+".hed")
+        if not (os.path.exists(pkgfile) and os.path.exists(hedfile)):
+            return False
+        return cache.checksum(hedfile) == entry["hed"] and pkgFingerprint(pkgfile, entry["pkg"], cache) == entry["pkg"]
+    def save(self):
+        tmpfn = self.path + ".tmp"
+        with open(tmpfn, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmpfn, self.path)
+
+def inputFingerprint(path):
+    try:
+        return statFingerprint(path)
+    except OSError:
+        return None
+
+_patch_plan_lock = threading.Lock()
+
+class PatchPlan:
+    #everything patch mode decides before touching the game: which mod file or kh2pcpatch member goes to which
+    #khbuild path, which were overridden and what couldn't be patched. settings and inputs (stat fingerprints of
+    #every mod file, mod folder and patch) say what it was made from, so a saved plan can be run again as long
+    #as none of them changed. files is {khbuild relative path: {"source", "member", "digest", "size"}}
+    def __init__(self, game, settings, files=None, conflicts=None, warnings=None, inputs=None):
+        self.game = game
+        self.settings = settings
+        self.files = files or {}
+        self.conflicts = conflicts or [] # [{"path", "used", "ignored"}]
+        self.warnings = warnings or []
+        self.inputs = inputs or {}
+    def warn(self, message):
+        print_debug("WARNING: " + message)
+        self.warnings.append(message)
+    def pkgs(self):
+        pkgs = {}
+        for newfn, entry in sorted(self.files.items()):
+            pkg = pkgs.setdefault(newfn.split(os.sep)[0], {"files": [], "bytes": 0})
+            pkg["files"].append(newfn)
+            pkg["bytes"] += entry["size"]
+        return pkgs
+    def staged(self):
+        #khbuild relative path -> mod filename, or (patch filename, ZipInfo) for kh2pcpatch members
+        staged = {}
+        members = {}
+        for newfn, entry in self.files.items():
+            if entry["member"] is None:
+                staged[newfn] = entry["source"]
+            else:
+                members.setdefault(entry["source"], []).append((newfn, entry["member"]))
+        for patch, names in members.items():
+            with ZipFile(patch) as input_zip:
+                for newfn, member in names:
+                    staged[newfn] = (patch, input_zip.getinfo(member))
+        return staged
+    def digests(self):
+        return {newfn: entry["digest"] for newfn, entry in self.files.items()}
+    def fresh(self, settings):
+        return settings == self.settings and all(inputFingerprint(path) == fingerprint for path, fingerprint in self.inputs.items())
+    def summary(self):
+        lines = ["{:<16}{:>8}{:>12}".format("pkg", "files", "MB")]
+        for pkg, info in self.pkgs().items():
+            lines.append("{:<16}{:>8}{:>12.1f}".format(pkg, len(info["files"]), info["bytes"] / 2**20))
+        for conflict in self.conflicts:
+            lines.append("conflict: {} from {} overrides {}".format(conflict["path"], ":".join(p for p in conflict["used"] if p), ":".join(p for p in conflict["ignored"] if p)))
+        lines.append("{} warnings, {} conflicts".format(len(self.warnings), len(self.conflicts)))
+        return "\n".join(lines)
+    def to_dict(self):
+        return {"settings": self.settings, "files": self.files, "pkgs": {pkg: info["bytes"] for pkg, info in self.pkgs().items()},
+                "conflicts": self.conflicts, "warnings": self.warnings, "inputs": self.inputs}
+    def save(self, path=PATCH_PLAN_PATH):
+        #one file holds the plans of several games
+        with _patch_plan_lock:
+            plans = json.load(open(path)) if os.path.exists(path) else {}
+            plans[self.game] = self.to_dict()
+            with open(path + ".tmp", "w") as f:
+                json.dump(plans, f, indent=1)
+            os.replace(path + ".tmp", path)
+    @staticmethod
+    def load(path, game):
+        if not os.path.exists(path):
+            return None
+        plan = json.load(open(path)).get(game)
+        if plan is None:
+            return None
+        return PatchPlan(game, plan["settings"], plan["files"], plan["conflicts"], plan["warnings"], plan["inputs"])
+
+def runPatch(idxpath, pkgfile, modfolder, outputdir, timeout=None):
+    for folder in ["remastered", "original", "raw"]:
+        if not os.path.exists(os.path.join(modfolder, folder)):
+            os.makedirs(os.path.join(modfolder, folder))
+    if os.path.exists(outputdir):
+        shutil.rmtree(outputdir)
+    args = [idxpath, "hed", "patch", pkgfile, modfolder, "-o", outputdir]
+    print_debug(args, verbose=False)
+    with getRunReport().phase("idximg patch", pkg=os.path.basename(pkgfile)[:-4], profile=False):
+        try:
+            runIdxImg(args, "Patch of {}".format(os.path.basename(pkgfile)), timeout=timeout, total=hedEntries(pkgfile[:-4]+".hed"))
+        except BaseException:
+            #a partial pkgoutput is never installed, and can be gigabytes
+            shutil.rmtree(outputdir, ignore_errors=True)
+            raise
+    return outputdir
+
+def patchAndHash(idxpath, pkgfile, modfolder, outputdir, timeout=None):
+    runPatch(idxpath, pkgfile, modfolder, outputdir, timeout=timeout)
+    pkg = os.path.basename(pkgfile)[:-4]
+    with getRunReport().phase("hash output", pkg=pkg):
+        return outputdir, {ext: md5File(os.path.join(outputdir, pkg+ext)) for ext in [".pkg", ".hed"]}
+
+def modAssetHashes(modfolder):
+    #hed name hashes of every asset a khbuild folder touches, remastered files are
+    #stored inside the asset named by the folders above them
+    names = set()
+    for folder in ["original", "raw", "remastered"]:
+        base = os.path.join(modfolder, folder)
+        for root, dirs, files in os.walk(base):
+            for file in files:
+                relpath = os.path.relpath(os.path.join(root, file), base).replace(os.sep, "/")
+                if folder == "remastered":
+                    parts = relpath.split("/")
+                    names.update(hedfile.nameHash("/".join(parts[:i])) for i in range(1, len(parts)))
+                else:
+                    names.add(hedfile.nameHash(relpath))
+    return names
 
+def patchDelta(idxpath, pkgfile, modfolder, outputdir, timeout=None):
+    #runs IdxImg against a hed that only lists the assets the mod touches, so the pkg it writes
+    #holds just those assets instead of a full copy of the original
+    pkg = os.path.basename(pkgfile)[:-4]
+    basedir = outputdir + "_base"
+    if os.path.exists(basedir):
+        shutil.rmtree(basedir)
+    os.makedirs(basedir)
+    basepkg = os.path.join(basedir, pkg+".pkg")
+    linkPkg(pkgfile, basepkg)
+    hedfile.filterHed(pkgfile[:-4]+".hed", basepkg[:-4]+".hed", modAssetHashes(modfolder))
+    try:
+        runPatch(idxpath, basepkg, modfolder, outputdir, timeout=timeout)
+    finally:
+        shutil.rmtree(basedir)
+    return outputdir, None
+
+def patchPkgs(idxpath, pkgdir, buildpath, pkgs, workers=DEFAULTWORKERS, onPatched=None, append=False, journal=None, slots=None, timeout=None):
+    #every pkg gets its own output folder so several IdxImg runs can be in flight at once.
+    #results are copied back as each run finishes, a failed pkg is never copied so the
+    #game is left with either the fully patched or the restored version of every pkg
+    cache = getChecksumCache()
+    outputroot = pkgOutputDir(pkgdir)
+    failed = []
+    with idxImgPool(workers) as pool:
+        jobs = {}
+        for pkg in pkgs:
+            print_debug("Patching: {}".format(pkg))
+            pkgfile = os.path.join(pkgdir, pkg+".pkg")
+            job = pool.submit(limited(slots, patchDelta if append else patchAndHash), idxpath, pkgfile, os.path.join(buildpath, pkg), os.path.join(outputroot, pkg), timeout=timeout)
+            jobs[job] = pkg
+        for job in as_completed(jobs):
+            pkg = jobs[job]
+            try:
+                outputdir, sums = job.result()
+            except Exception as err:
+                print_debug("ERROR: {}".format(err))
+                failed.append(pkg)
+                continue
+            base_size = None
+            with getRunReport().phase("install", pkg=pkg):
+                if append:
+                    #the new assets are added to the end of the pkg in place, then the hed is swapped for one pointing at them
+                    pkgfile = os.path.join(pkgdir, pkg+".pkg")
+                    if journal:
+                        journal.begin(pkgdir, pkg, base_size=os.path.getsize(pkgfile))
+                    base_size = hedfile.appendAssets(pkgfile, os.path.join(pkgdir, pkg+".hed"), os.path.join(outputdir, pkg+".pkg"), os.path.join(outputdir, pkg+".hed"))
+                    getRunReport().count(files=1, bytes=os.path.getsize(os.path.join(outputdir, pkg+".pkg")))
+                    sums = {".pkg": statFingerprint(pkgfile), ".hed": md5File(os.path.join(pkgdir, pkg+".hed"))}
+                    cache.record(os.path.join(pkgdir, pkg+".hed"), sums[".hed"])
+                else:
+                    if journal:
+                        journal.begin(pkgdir, pkg)
+                    for ext in [".pkg", ".hed"]:
+                        installFile(os.path.join(outputdir, pkg+ext), os.path.join(pkgdir, pkg+ext), move=True)
+                        cache.record(os.path.join(pkgdir, pkg+ext), sums[ext])
+                if journal:
+                    journal.commit(pkgdir, pkg)
+                cache.save()
+                shutil.rmtree(outputdir)
+            print_debug("Patched: {}".format(pkg))
+            if onPatched:
+                onPatched(pkg, sums, base_size)
+    if failed:
+        raise Exception("Patch failed for {}".format(", ".join(sorted(failed))))
+
+class PollWatcher:
+    #notices changes under some folders by comparing stat snapshots, works everywhere
+    def __init__(self, paths, interval=WATCH_POLL_INTERVAL):
+        self.paths = [path for path in paths if path]
+        self.interval = interval
+        self.snapshot = self._snapshot()
+    def _snapshot(self):
+        snapshot = {}
+        for path in self.paths:
+            for root, dirs, files in os.walk(path):
+                for file in files:
+                    fn = os.path.join(root, file)
+                    try:
+                        st = os.stat(fn)
+                    except OSError:
+                        continue
+                    snapshot[fn] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+    def changes(self, timeout):
+        #polls every interval until something changed or timeout runs out
+        deadline = time.time() + timeout
+        while True:
+            time.sleep(max(0, min(deadline - time.time(), self.interval)))
+            snapshot = self._snapshot()
+            changed = set(fn for fn in set(snapshot) | set(self.snapshot) if snapshot.get(fn) != self.snapshot.get(fn))
+            self.snapshot = snapshot
+            if changed or time.time() >= deadline:
+                return changed
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    #linux only, same interface as PollWatcher but woken by the kernel instead of rescanning the folders.
+    #each folder's parent is watched too, so a folder that is missing at first, or deleted and made again,
+    #is picked up when it appears. changes returns None when the kernel dropped events, anything may have changed
+    IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x2, 0x8, 0x40, 0x80, 0x100, 0x200
+    IN_DELETE_SELF, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x400, 0x4000, 0x8000, 0x40000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT = struct.Struct("iIII")
+    def __init__(self, paths):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.roots = [os.path.abspath(path) for path in paths if path]
+        self.dirs = {}
+        self._overflow = False
+        for root in self.roots:
+            self._watch(os.path.dirname(root))
+        self._watchRoots()
+    def _watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for {}".format(path))
+        self.dirs[wd] = path
+    def _watchTree(self, path):
+        #returns the files already in it, a new folder may have some by the time it's being watched
+        files_found = set()
+        for root, dirs, files in os.walk(path):
+            try:
+                self._watch(root)
+            except OSError:
+                if os.path.exists(root):
+                    raise
+                continue #deleted again in the meantime
+            files_found.update(os.path.join(root, file) for file in files)
+        return files_found
+    def _watchRoots(self):
+        for root in self.roots:
+            self._watchTree(root)
+    def _watched(self, fn):
+        return any(fn == root or fn.startswith(root + os.sep) for root in self.roots)
+    def changes(self, timeout):
+        #files changing next to a watched folder wake this up too, those don't count
+        deadline = time.time() + timeout
+        changed = set()
+        while not changed and not self._overflow:
+            if not select.select([self.fd], [], [], max(0, deadline - time.time()))[0]:
+                return changed
+            self._read(changed)
+        if self._overflow:
+            #folders made while events were being dropped aren't watched yet
+            self._overflow = False
+            self._watchRoots()
+            return None
+        return changed
+    def _read(self, changed):
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            name = data[offset+self.EVENT.size:offset+self.EVENT.size+length].rstrip(b"\0")
+            offset += self.EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                self._overflow = True
+                continue
+            if mask & self.IN_IGNORED:
+                #the folder was deleted, or moved away and unwatched below
+                self.dirs.pop(wd, None)
+                continue
+            if wd not in self.dirs or not name:
+                continue
+            fn = os.path.join(self.dirs[wd], os.fsdecode(name))
+            if not self._watched(fn):
+                continue #something else in a watched folder's parent
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    changed.update(self._watchTree(fn))
+                elif mask & self.IN_MOVED_FROM:
+                    #the files in it are gone without an event for each of them
+                    for movedwd, path in list(self.dirs.items()):
+                        if path == fn or path.startswith(fn + os.sep):
+                            self.libc.inotify_rm_watch(self.fd, movedwd)
+                            self.dirs.pop(movedwd)
+                    self._overflow = True
+                continue
+            changed.add(fn)
+    def close(self):
+        os.close(self.fd)
+
+def watchFolders(paths):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError) as err:
+            print_debug("WARNING: inotify unavailable ({}), polling for changes instead".format(err))
+    return PollWatcher(paths)
+
+def configGames(config):
+    #config.json from older versions holds a single game name rather than a list
+    game = config.get("game")
+    if isinstance(game, str):
+        return [game]
+    return game
+
+def parserOptions(default_config):
+    #the argument groups shared by the Gooey ui and the plain command line, as (title, description, [(args, kwargs)])
+    #fallback measure for backwards compalibility with the old config.json
+    getmode = DEFAULTMODE
+    if default_config.get("mode") is not None:
+        if "fast" in default_config.get("mode"):
+            getmode = "fast_patch"
+    return [
+        ("Main options", "The main options around the mode and game to use. All required", [
+            (["-game"], dict(choices=list(games.keys()), nargs="+", default=configGames(default_config), help="Which games to operate on, several games are run at the same time.", required=True)),
+            (["-mode"], dict(choices=["extract", "patch", "restore", "fast_patch", "fast_restore", "watch", "plan"], default=getmode, help="Which mode to run (`Patch` patches the game, `Extract` extracts the pkg files for the game, `Restore` will restore the backed up pkg files without patching anything, `Watch` patches and then keeps repatching whenever the mods change, and `Plan` shows what patch would do without changing anything)", required=True)),
+            #removed `uk` from region choices. uk just uses us for everything anyway aside from some journal stuff so it's not worth using ever and causes confusion in my opinion.
+            (["-region"], dict(choices=["jp", "us", "it", "sp", "gr", "fr"], default=default_config.get("region", ""), help="defaults to 'us', needed to make sure the correct files are patched")),
+        ]),
+        ("Setup", "Paths that must be configured to make sure the patcher works properly.", [
+            (["-openkh_path"], dict(help="Path to OpenKH folder.", default=default_config.get("openkh_path"), widget='DirChooser')),
+            (["-extracted_games_path"], dict(help="Path to folder containing extracted games", default=default_config.get("extracted_games_path"), widget='DirChooser')),
+            (["-khgame_path"], dict(help="Path to the Kingdom Hearts game install directory.", default=default_config.get("khgame_path"), widget='DirChooser')),
+            (["-patches_path"], dict(help="(Optional) Path to directory containing other kh2pcpatches to apply. Will be applied in alphabetical order (Mods Manager mods will be applied last).", default=default_config.get("patches_path"), widget='DirChooser')),
+        ]),
+        ("Advanced Options", "Development options for the most part, if you don't know what these do then leave them alone.", [
+            (["-keepkhbuild"], dict(action="store_true", default=False, help="Will keep the intermediate khbuild folder from being deleted after the patch is applied")),
+            (["-ignorebadchecksum"], dict(action="store_true", default=False, help="If true, disabled backing up and restoring the original PKG files based on checksums (you probably don't want to check this option)")),
+            (['-failonmissing'], dict(action="store_true", default=False, help="If true, fails when a file can't be patched to a PKG, rather than printing a warning")),
+            (['-appendpatch'], dict(action="store_true", default=False, help="Patch by appending only the changed files to the end of the original PKG instead of rewriting the whole PKG")),
+            (['-plan'], dict(default="", help="Plan mode: save the plan to this file. Patch mode: run the plan saved in this file, if the mods haven't changed since it was made", widget='FileSaver')),
+            (['-include'], dict(nargs="*", default=[], help="Extract mode: only extract the files matching these patterns, e.g. bgm/*.scd (matched against the pkgmap paths, * matches across folders)")),
+            (['-exclude'], dict(nargs="*", default=[], help="Extract mode: don't extract the files matching these patterns")),
+            (['-resume'], dict(action="store_true", default=False, help="Extract mode: keep a previous, interrupted extraction and only extract the HEDs that didn't finish")),
+            (['-compressbackup'], dict(action="store_true", default=False, help="Compress new backups of the original PKG files (slower, but they take less space)")),
+            (['-profile'], dict(action="store_true", default=False, help="Profile the python side of the run with cProfile, the stats are written to run_profile.prof")),
+            (['-workers'], dict(type=int, default=DEFAULTWORKERS, help="How many PKGs to hash or patch at the same time")),
+            (['-timeout'], dict(type=float, default=0, help="Stop an IdxImg run that takes longer than this many seconds (0 for no limit)")),
+            (['-debounce'], dict(type=float, default=WATCH_DEBOUNCE, help="Watch mode: how many seconds the mods have to stop changing before repatching")),
+        ]),
+    ]
+
+def buildParser(default_config, gui=False):
+    #only the ui pays for importing Gooey, the command line gets a plain argparse parser without the widget options
+    if gui:
+        from gooey import GooeyParser
+        parser = GooeyParser()
+    else:
+        parser = argparse.ArgumentParser()
+    for title, description, options in parserOptions(default_config):
+        group = parser.add_argument_group(title, description)
+        for names, kwargs in options:
+            if not gui:
+                kwargs.pop("widget", None)
+            group.add_argument(*names, **kwargs)
+    return parser
+
+class PatchSession:
+    #runs patch/restore/extract without any ui, for scripts and repeated runs in the same process. the
+    #Patchers, pkgmaps, backup store, manifest and journal are loaded once and reused by every run,
+    #the checksum cache is shared through getChecksumCache()
+    def __init__(self, openkh_path, khgame_path, extracted_games_path="", patches_path="", region=DEFAULTREGION, workers=DEFAULTWORKERS,
+                 keepkhbuild=False, ignorebadchecksum=False, failonmissing=False, appendpatch=False, compressbackup=False, profile=False,
+                 include=None, exclude=None, plan_path=None, timeout=None):
+        self.openkh_path = openkh_path
+        self.khgame_path = khgame_path
+        self.extracted_games_path = extracted_games_path
+        self.patches_path = patches_path
+        self.region = region
+        self.workers = workers
+        self.keepkhbuild = keepkhbuild
+        self.ignorebadchecksum = ignorebadchecksum
+        self.failonmissing = failonmissing
+        self.appendpatch = appendpatch
+        self.profile = profile
+        self.include = include or []
+        self.plan_path = plan_path
+        self.timeout = timeout or None
+        self.exclude = exclude or []
+        self.compressbackup = compressbackup
+        self._store = None
+        self._store_lock = threading.Lock()
+        self.manifest = BuildManifest()
+        self.journal = RestoreJournal()
+        self.pkgmap_index = PkgMapIndex()
+        self.slots = threading.BoundedSemaphore(max(1, workers))
+        self._games = {}
+        self._pkgmaps = {} # game name -> (pkgmap source stamp, GamePkgMap)
+    def backupStore(self):
+        #made on first use, so sessions that never back up or restore don't leave a backup_store behind
+        with self._store_lock:
+            if self._store is None:
+                self._store = BackupStore(compress=self.compressbackup)
+            return self._store
+    def game(self, gamename):
+        if not gamename in games:
+            raise Exception("Game not found, possible options: {}".format(list(games.keys())))
+        if gamename not in self._games:
+            self._games[gamename] = games[gamename](region=self.region)
+        return self._games[gamename]
+    def pkgmap(self, gamename):
+        #reloaded when one of the pkgmap json files changes between runs
+        stamp = self.pkgmap_index._stamp()
+        if self._pkgmaps.get(gamename, (None, None))[0] != stamp:
+            self._pkgmaps[gamename] = (stamp, self.pkgmap_index.load(gamename))
+        return self._pkgmaps[gamename][1]
+    def patch(self, gamename, fast=False):
+        return self.run(gamename, "fast_patch" if fast else "patch")
+    def restore(self, gamename, fast=False):
+        return self.run(gamename, "fast_restore" if fast else "restore")
+    def extract(self, gamename, resume=False):
+        return self.run(gamename, "extract", resume=resume)
+    def affectedPkgs(self, gamename, paths, fast=False):
+        #which pkgs the changed files patch into, None if that can't be told and every pkg has to be checked.
+        #paths is None when the watcher lost track of what changed
+        if paths is None:
+            return None
+        game = self.game(gamename)
+        pkgmap = self.pkgmap(game.name)
+        moddir = os.path.join(self.openkh_path, "mod")
+        pkgs = set()
+        for fn in paths:
+            if self.patches_path and os.path.abspath(fn).startswith(os.path.abspath(self.patches_path)):
+                if fn.endswith(".kh2pcpatch"):
+                    return None
+                continue
+            #watchers may report absolute paths while openkh_path is relative, or the other way around
+            relfn = os.sep + os.path.relpath(os.path.abspath(fn), os.path.abspath(moddir))
+            relfn_trans = game.translate_path(relfn, moddir)
+            for pkg in lookupPkgs(pkgmap, relfn_trans):
+                pkgs.add(gamename + "_first" if fast else pkg)
+        return pkgs
+    def watch(self, gamename, fast=False, debounce=WATCH_DEBOUNCE):
+        #patches once, then repatches the pkgs the mods patch into every time the Mods Manager output or the
+        #extra patches change. runs until interrupted
+        mode = "fast_patch" if fast else "patch"
+        watcher = watchFolders([os.path.join(self.openkh_path, "mod"), self.patches_path])
+        try:
+            self.run(gamename, mode)
+            while True:
+                print_debug("Watching for mod changes")
+                changed = watcher.changes(3600)
+                while changed is None or changed:
+                    #a build writes many files, wait for it to go quiet before patching
+                    more = watcher.changes(debounce)
+                    if more is not None and not more:
+                        break
+                    changed = None if changed is None or more is None else changed | more
+                if changed is not None and not changed:
+                    continue
+                pkgs = self.affectedPkgs(gamename, changed, fast=fast)
+                if pkgs is not None and not pkgs:
+                    print_debug("{} files changed but none of them are patched into a pkg".format(len(changed)))
+                    continue
+                what = "{} files changed".format(len(changed)) if changed is not None else "Lost track of the changes"
+                print_debug("{}, repatching {}".format(what, ", ".join(sorted(pkgs)) if pkgs is not None else "every pkg"))
+                try:
+                    self.run(gamename, mode, only=pkgs)
+                except Exception as err:
+                    print_debug("ERROR: {}".format(err))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+    def run(self, gamename, mode, resume=False, only=None):
+        #only limits restoring and patching to the named pkgs (without .pkg), the rest of the game is left as it is
+        starttime = time.time()
+        report = startRunReport(profile=self.profile)
+        _idximg_cancelled.clear()
+        self._run(gamename, mode, resume=resume, only=only)
+        print_debug(report.summary())
+        report.write(os.path.join(os.path.dirname(os.path.abspath("config.json")), RUN_REPORT_PATH), mode=mode, game=gamename)
+        print_debug("All done! Took {}s".format(round(time.time()-starttime, 2)) + " | Mode: " + mode)
+        return report
+    def batch(self, gamenames, mode, resume=False):
+        #runs several games at once, they share the -workers job slots and one run report
+        if len(gamenames) == 1:
+            return self.run(gamenames[0], mode, resume=resume)
+        starttime = time.time()
+        report = startRunReport(profile=self.profile)
+        for gamename in gamenames:
+            self.pkgmap(self.game(gamename).name)
+        def runGame(gamename):
+            report.setGame(gamename)
+            self._run(gamename, mode, resume=resume)
+        failed = []
+        _idximg_cancelled.clear()
+        with idxImgPool(len(gamenames)) as pool:
+            jobs = {pool.submit(runGame, gamename): gamename for gamename in gamenames}
+            for job in as_completed(jobs):
+                try:
+                    job.result()
+                except Exception as err:
+                    print_debug("ERROR: {} failed: {}".format(jobs[job], err))
+                    failed.append(jobs[job])
+        print_debug(report.summary())
+        report.write(os.path.join(os.path.dirname(os.path.abspath("config.json")), RUN_REPORT_PATH), mode=mode, game=gamenames, failed=sorted(failed))
+        print_debug("All done! Took {}s".format(round(time.time()-starttime, 2)) + " | Mode: " + mode + " | Games: " + ", ".join(gamenames))
+        if failed:
+            raise Exception("{} failed for {}".format(mode, ", ".join(sorted(failed))))
+        return report
+    def planSettings(self, gamename, fast=False, only=None):
+        #everything besides the mod files that a plan depends on
+        return {"game": gamename, "region": self.region, "fast": fast, "openkh_path": os.path.abspath(self.openkh_path),
+                "patches_path": os.path.abspath(self.patches_path) if self.patches_path else "", "failonmissing": self.failonmissing,
+                "pkgmap": self.pkgmap_index._stamp(), "only": sorted(only) if only is not None else None}
+    def plan(self, gamename, fast=False, only=None):
+        #works out what patching would do without touching the game or khbuild
+        game = self.game(gamename)
+        pkgmap = self.pkgmap(game.name)
+        MODDIR = os.path.join(self.openkh_path, "mod")
+        extra_patches_dir = self.patches_path or ''
+        ignoremissing = not self.failonmissing
+        plan = PatchPlan(game.name, self.planSettings(gamename, fast, only))
+        plan.inputs[MODDIR] = inputFingerprint(MODDIR)
+        staged = {}
+        with getRunReport().phase("scan"):
+            if os.path.exists(MODDIR):
+                modfiles = []
+                for root, dirs, files in os.walk(MODDIR):
+                    #a folder's stat changes when files are added to or removed from it
+                    plan.inputs[root] = inputFingerprint(root)
+                    for file in files:
+                        fn = os.path.join(root, file)
+                        modfiles.append((fn, fn.replace(MODDIR, '')))
+                getRunReport().count(files=len(modfiles))
+                translated = game.translate_paths([relfn for fn, relfn in modfiles], MODDIR)
+                for fn, relfn in modfiles:
+                    plan.inputs[fn] = inputFingerprint(fn)
+                    relfn_trans = translated[relfn]
+                    print_debug("Translated Filename: {}".format(relfn_trans), verbose=True)
+                    pkgs = lookupPkgs(pkgmap, relfn_trans)
+                    if not pkgs:
+                        plan.warn("Could not find which pkg this path belongs, file not patched: {} (original path {})".format(relfn_trans, relfn))
+                        if not ignoremissing:
+                            raise Exception("Exiting due to warning")
+                        continue
+                    #only patch if the file does not exist in the blacklist pkgmap.
+                    if pkgmap.blacklisted(relfn_trans):
+                        plan.warn("File blacklisted, file not patched: {})".format(relfn_trans))
+                        if not ignoremissing:
+                            raise Exception("Exiting due to warning")
+                        continue
+                    for pkg in pkgs:
+                        #default
+                        pkgname = pkg
+                        #fast_patch forces the pkg name to be the first PKG for all file, if the 
+                        #gamename isn't Recom or Movies as those are only in a single PKG anyway.
+                        if fast:
+                            if gamename != "Recom" or gamename != "Movies":
+                                pkgname = gamename + "_first"
+                        #"remastered" and "raw" paths are always already in their own folders 
+                        #so no need to add the folder name to the newfn path.
+                        if "remastered"+os.sep in relfn_trans or "raw"+os.sep in relfn_trans:
+                            newfn = os.path.join(pkgname, relfn_trans)
+                        else:
+                            newfn = os.path.join(pkgname, "original", relfn_trans)
+                        if only is None or pkgname in only:
+                            if os.path.normpath(newfn) in staged and staged[os.path.normpath(newfn)] != fn:
+                                plan.conflicts.append({"path": os.path.normpath(newfn), "used": [fn, None], "ignored": [staged[os.path.normpath(newfn)], None]})
+                            staged[os.path.normpath(newfn)] = fn
+        with getRunReport().phase("hash inputs"):
+            mod_checksums = getChecksumCache().checksum_many(set(staged.values()), workers=self.workers, slots=self.slots)
+            for newfn, fn in staged.items():
+                plan.files[newfn] = {"source": fn, "member": None, "digest": mod_checksums[fn], "size": os.path.getsize(fn)}
+            getChecksumCache().save()
+        with getRunReport().phase("index patches"):
+            other_patches = []
+            if extra_patches_dir and os.path.exists(extra_patches_dir):
+                plan.inputs[extra_patches_dir] = inputFingerprint(extra_patches_dir)
+                other_patches = [os.path.join(extra_patches_dir,p) for p in os.listdir(extra_patches_dir) if p.endswith(".kh2pcpatch")] #TODO double check extension
+            patch_index = {}
+            for patch in sorted(other_patches):
+                plan.inputs[patch] = inputFingerprint(patch)
+                #indexed one at a time to see which members a later patch overrides
+                for newfn, (patch, info) in indexPatches([patch], gamename, fast).items():
+                    if newfn in patch_index:
+                        plan.conflicts.append({"path": newfn, "used": [patch, info.filename], "ignored": [patch_index[newfn][0], patch_index[newfn][1].filename]})
+                    patch_index[newfn] = (patch, info)
+            #compared the way the filesystem does, on windows a member differing only in case is the same file
+            modfiles = {os.path.normcase(newfn): newfn for newfn in plan.files}
+            for newfn, (patch, info) in patch_index.items():
+                if only is not None and newfn.split(os.sep)[0] not in only:
+                    continue
+                # mods manager needs to take priority
+                if os.path.normcase(newfn) in modfiles:
+                    modfn = modfiles[os.path.normcase(newfn)]
+                    plan.conflicts.append({"path": modfn, "used": [plan.files[modfn]["source"], None], "ignored": [patch, info.filename]})
+                    continue
+                plan.files[newfn] = {"source": patch, "member": info.filename, "digest": "zip:{:08x}:{}".format(info.CRC, info.file_size), "size": info.file_size}
+        return plan
+    def _run(self, gamename, mode, resume=False, only=None):
+        manifest = self.manifest
+        journal = self.journal
+
+        IDXDIR = self.openkh_path
+        IDXPATH = os.path.join(IDXDIR, "OpenKh.Command.IdxImg.exe")
+
+        game = self.game(gamename)
+
+        PKGDIR = game.translate_pkg_path(os.path.join(self.khgame_path, "Image", "en"))
+
+        if not os.path.exists(PKGDIR):
+            raise Exception("PKG dir not found")
+        if not os.path.exists(IDXPATH):
+            raise Exception("OpenKh.Command.IdxImg.exe not found")
+
+        patch = True if mode in ["patch", "fast_patch"] else False
+        fastpatch = True if mode == "fast_patch" else False
+        extract = True if mode == "extract" else False
+
+        keepkhbuild = self.keepkhbuild
+        validate_checksum = self.ignorebadchecksum
+        workers = self.workers
+
+        backup = True if mode in ["patch", "fast_patch"] else False
+        restore = True if mode in ["patch", "restore", "fast_patch", "fast_restore"] else False
+        fastrestore = True if mode in ["fast_patch", "fast_restore"] else False
+
+        with getRunReport().phase("load pkgmap"):
+            pkgmap = self.pkgmap(game.name)
+
+        if mode == "plan":
+            plan = self.plan(gamename, only=only)
+            print_debug(plan.summary())
+            if self.plan_path:
+                plan.save(self.plan_path)
+            return
+        if extract:
+            print_debug("Extracting {}".format(game.name))
+            if not os.path.exists(self.extracted_games_path):
+                raise Exception("Path does not exist to extract games to! {}".format(self.extracted_games_path))
+            print(game.name)
+            pkglist = [os.path.join(PKGDIR,p) for p in os.listdir(PKGDIR) if game.name.lower() in p.lower() and p.endswith(".hed")]
+            assets = None
+            filterkey = None
+            if self.include or self.exclude:
+                #only the pkgs holding matching paths are extracted, and only the matching assets in them
+                assets = matchAssets(pkgmap, self.include, self.exclude)
+                pkglist = [hedfn for hedfn in pkglist if os.path.basename(hedfn)[:-4] in assets]
+                filterkey = json.dumps([sorted(self.include), sorted(self.exclude)])
+                print_debug("{} assets in {} pkgs match the filters".format(sum(len(assets[os.path.basename(hedfn)[:-4]]) for hedfn in pkglist), len(pkglist)))
+            EXTRACTED_GAME_PATH = os.path.join(self.extracted_games_path, game.name)
+            if EXTRACTED_GAME_PATH.endswith("kh3d"):
+                EXTRACTED_GAME_PATH = EXTRACTED_GAME_PATH.replace("kh3d", "ddd")
+            print(EXTRACTED_GAME_PATH)
+            print_debug(pkglist, verbose=True)
+            with getRunReport().phase("extract", profile=False):
+                extractHeds(IDXPATH, pkglist, EXTRACTED_GAME_PATH, workers=workers, validate_checksum=validate_checksum, resume=resume, slots=self.slots, assets=assets, filterkey=filterkey, timeout=self.timeout)
+        if backup:
+            with getRunReport().phase("backup"):
+                with getRunReport().pool(workers) as pool:
+                    for job in [pool.submit(limited(self.slots, backupPkg), self.backupStore(), PKGDIR, pkg) for pkg in game.pkgs]:
+                        job.result()
+                getChecksumCache().save()
+        staged = {} # khbuild relative path -> mod filename, or (patch filename, ZipInfo) for kh2pcpatch members
+        staged_digests = {} # khbuild relative path -> content hash
+        uptodate = set()
+        if patch:
+            plan = None
+            if self.plan_path:
+                plan = PatchPlan.load(self.plan_path, game.name)
+                if plan is not None and plan.fresh(self.planSettings(gamename, fastpatch, only)):
+                    print_debug("Running the saved plan from {}".format(self.plan_path))
+                else:
+                    if plan is not None:
+                        print_debug("The mods changed since {} was made, planning again".format(self.plan_path))
+                    plan = None
+            if plan is None:
+                plan = self.plan(gamename, fast=fastpatch, only=only)
+            staged = plan.staged()
+            staged_digests = plan.digests()
+            with getRunReport().phase("check manifest"):
+                pkg_inputs = {}
+                for newfn in staged:
+                    pkg_inputs.setdefault(newfn.split(os.sep)[0], {})[newfn] = staged_digests[newfn]
+                pkg_inputs = {pkg: inputsDigest(inputs) for pkg, inputs in pkg_inputs.items()}
+                for pkg in pkg_inputs:
+                    if manifest.upToDate(game.name, pkg, pkg_inputs[pkg], PKGDIR, getChecksumCache()):
+                        print_debug("{} is already patched with the current mods, skipping it".format(pkg))
+                        uptodate.add(pkg)
+                getChecksumCache().save()
+        if restore:
+            with getRunReport().phase("restore"):
+                print_debug("Restoring from backup")
+                def onRestored(pkg):
+                    manifest.remove(game.name, pkg.split(".pkg")[0])
+                    journal.remove(PKGDIR, pkg.split(".pkg")[0])
+                journaled = journal.pkgs(PKGDIR)
+                restore_pkgs = [pkg for pkg in game.pkgs if only is None or pkg.split(".pkg")[0] in only]
+                if fastrestore:
+                    restore_pkgs = [pkg for pkg in restore_pkgs if pkg == gamename + "_first.pkg"]
+                #a pkg restore never checksummed may have been patched by an older version, without a journal. after
+                #that only the pkgs the journal says were replaced need looking at, and comparing stat fingerprints is enough
+                unscanned = [pkg.split(".pkg")[0] for pkg in restore_pkgs if not journal.scanned(PKGDIR, pkg.split(".pkg")[0])]
+                getChecksumCache().checksum_many([os.path.join(PKGDIR, pkgname+".hed") for pkgname in unscanned if pkgname not in uptodate], workers=workers, slots=self.slots)
+                to_restore = {}
+                for pkg in restore_pkgs:
+                    pkgname = pkg.split(".pkg")[0]
+                    entry = journaled.get(pkgname)
+                    if pkgname in uptodate:
+                        if entry is None:
+                            journal.adopt(PKGDIR, pkgname, base_size=manifest.get(game.name, pkgname)["base_size"])
+                        if entry is None or entry["state"] == "committed":
+                            continue
+                    if pkgname in unscanned and not validChecksum(os.path.join(PKGDIR, pkgname+".hed")):
+                        to_restore[pkg] = entry
+                    elif entry is not None:
+                        if journal.untouched(PKGDIR, pkgname):
+                            onRestored(pkg)
+                        else:
+                            to_restore[pkg] = entry
+                restorePkgs(self.backupStore(), PKGDIR, to_restore, workers=workers, onRestored=onRestored, slots=self.slots)
+                #every one of them is original or journaled now
+                journal.setScanned(PKGDIR, unscanned)
+        if patch:
+            print_debug("Patching")
+            #one build folder per game so games being patched at the same time don't share one
+            buildpath = os.path.join("khbuild", game.name)
+            with getRunReport().phase("staging"):
+                if os.path.exists(buildpath):
+                    shutil.rmtree(buildpath)
+                os.makedirs(buildpath)
+                patch_members = {}
+                for newfn, source in staged.items():
+                    if newfn.split(os.sep)[0] in uptodate:
+                        continue
+                    if isinstance(source, tuple):
+                        patch_members[newfn] = source
+                        continue
+                    newfn = os.path.join(buildpath, newfn)
+                    new_basedir = os.path.dirname(newfn)
+                    if not os.path.exists(new_basedir):
+                        os.makedirs(new_basedir)
+                    stageFile(source, newfn)
+            with getRunReport().phase("patch ingestion"):
+                extractPatches(patch_members, buildpath, workers=workers)
+            def onPatched(pkg, sums, base_size):
+                manifest.set(game.name, pkg, pkg_inputs[pkg], sums[".pkg"], sums[".hed"], base_size=base_size)
+            with getRunReport().phase("patch", profile=False):
+                patchPkgs(IDXPATH, PKGDIR, buildpath, sorted(os.listdir(buildpath)), workers=workers, onPatched=onPatched, append=self.appendpatch, journal=journal, slots=self.slots, timeout=self.timeout)
+            if not keepkhbuild:
+                shutil.rmtree(buildpath)
+                try:
+                    os.rmdir("khbuild")
+                except OSError:
+                    pass #another game is still using it
+
+def main_ui():
+    from gooey import Gooey
+    @Gooey(program_name="Mod Manager Bridge")
+    def run():
+        main(gui=True)
+    run()
+
+def main(cli_args: list = [], gui=False):
     default_config = {
         "game": DEFAULTGAME,
         "mode": DEFAULTMODE,
@@ -223,51 +1977,17 @@ def main(cli_args: list = []):
     if os.path.exists("config.json"):
         default_config = json.load(open("config.json"))
 
-    parser = GooeyParser()
-
-    main_options = parser.add_argument_group(
-        "Main options",
-        "The main options around the mode and game to use. All required"
-    )
-    
-    #fallback measure for backwards compalibility with the old config.json
-    getmode = DEFAULTMODE
-    if default_config.get("mode") is not None:
-        if "fast" in default_config.get("mode"):
-            getmode = "fast_patch"
-
-    main_options.add_argument("-game", choices=list(games.keys()), default=default_config.get("game"), help="Which game to operate on.", required=True)
-    main_options.add_argument("-mode", choices=["extract", "patch", "restore", "fast_patch", "fast_restore"], default=getmode, help="Which mode to run (`Patch` patches the game, `Extract` extracts the pkg files for the game, and `Restore` will restore the backed up pkg files without patching anything)", required=True)
-    #removed `uk` from region choices. uk just uses us for everything anyway aside from some journal stuff so it's not worth using ever and causes confusion in my opinion.
-    main_options.add_argument("-region", choices=["jp", "us", "it", "sp", "gr", "fr"], default=default_config.get("region", ""), help="defaults to 'us', needed to make sure the correct files are patched")
-
-
-    main_options = parser.add_argument_group(
-        "Setup",
-        "Paths that must be configured to make sure the patcher works properly."
-    )
-    main_options.add_argument("-openkh_path", help="Path to OpenKH folder.", default=default_config.get("openkh_path"), widget='DirChooser')
-    main_options.add_argument("-extracted_games_path", help="Path to folder containing extracted games", default=default_config.get("extracted_games_path"), widget='DirChooser')
-    main_options.add_argument("-khgame_path", help="Path to the Kingdom Hearts game install directory.", default=default_config.get("khgame_path"), widget='DirChooser')
-    main_options.add_argument("-patches_path", help="(Optional) Path to directory containing other kh2pcpatches to apply. Will be applied in alphabetical order (Mods Manager mods will be applied last).", default=default_config.get("patches_path"), widget='DirChooser')
-
-
-    advanced_options = parser.add_argument_group(
-        "Advanced Options",
-        "Development options for the most part, if you don't know what these do then leave them alone."
-    )
-    advanced_options.add_argument("-keepkhbuild", action="store_true", default=False, help="Will keep the intermediate khbuild folder from being deleted after the patch is applied")
-    advanced_options.add_argument("-ignorebadchecksum", action="store_true", default=False, help="If true, disabled backing up and restoring the original PKG files based on checksums (you probably don't want to check this option)")
-    advanced_options.add_argument('-failonmissing', action="store_true", default=False, help="If true, fails when a file can't be patched to a PKG, rather than printing a warning")
+    parser = buildParser(default_config, gui=gui)
     
     # Parse and print the results
     if cli_args:
         args = parser.parse_args(cli_args)
     else:
-        args = parser.parse_args()
+        #`cmd` only picks the command line over the ui, it isn't an option
+        args = parser.parse_args([arg for arg in sys.argv[1:] if arg != "cmd"])
 
     config_to_write = {
-        "game": args.game,
+        "game": args.game[0] if len(args.game) == 1 else args.game,
         "mode": args.mode,
         "openkh_path": args.openkh_path,
         "extracted_games_path": args.extracted_games_path,
@@ -277,222 +1997,16 @@ def main(cli_args: list = []):
     }
     json.dump(config_to_write, open("config.json", "w"))
 
-    MODDIR = os.path.join(args.openkh_path, "mod")
-    IDXDIR = args.openkh_path
-    IDXPATH = os.path.join(IDXDIR, "OpenKh.Command.IdxImg.exe")
-
-    gamename = args.game
-    if not args.game in games:
-        raise Exception("Game not found, possible options: {}".format(list(games.keys())))
-    region = args.region
-    game = games[gamename](region=region)
-
-    PKGDIR = game.translate_pkg_path(os.path.join(args.khgame_path, "Image", "en"))
-
-    if not os.path.exists(PKGDIR):
-        raise Exception("PKG dir not found")
-    if not os.path.exists(IDXPATH):
-        raise Exception("OpenKh.Command.IdxImg.exe not found")
-
-    mode = args.mode
-    patch = True if mode in ["patch", "fast_patch"] else False
-    fastpatch = True if mode == "fast_patch" else False
-    extract = True if mode == "extract" else False
-
-    extra_patches_dir = args.patches_path or ''
-
-    keepkhbuild = args.keepkhbuild
-    validate_checksum = args.ignorebadchecksum
-    ignoremissing = not args.failonmissing
-
-    backup = True if mode in ["patch", "fast_patch"] else False
-    restore = True if mode in ["patch", "restore", "fast_patch", "fast_restore"] else False
-    fastrestore = True if mode in ["fast_patch", "fast_restore"] else False
-
-    pkgmap = json.load(open("pkgmap.json")).get(game.name, {})
-    pkgmap_extras = json.load(open("pkgmap_extras.json")).get(game.name, {}) # predefined extras for patches that fail otherwise, such as GOA ROM
-    pkgmap_blacklist = json.load(open("pkgmap_blacklist.json")).get(game.name, {}) # blacklist of bad files to replace
-    pkgmap.update(pkgmap_extras)
-
-    if extract:
-        print_debug("Extracting {}".format(game.name))
-        if not os.path.exists(args.extracted_games_path):
-            raise Exception("Path does not exist to extract games to! {}".format(args.extracted_games_path))
-        print(game.name)
-        pkglist = [os.path.join(PKGDIR,p) for p in os.listdir(PKGDIR) if game.name.lower() in p.lower() and p.endswith(".hed")]
-        if os.path.exists("extractedout"):
-            shutil.rmtree("extractedout")
-        os.makedirs("extractedout")
-        EXTRACTED_GAME_PATH = os.path.join(args.extracted_games_path, game.name)
-        if EXTRACTED_GAME_PATH.endswith("kh3d"):
-            EXTRACTED_GAME_PATH = EXTRACTED_GAME_PATH.replace("kh3d", "ddd")
-        print(EXTRACTED_GAME_PATH)
-        if os.path.exists(EXTRACTED_GAME_PATH):
-            shutil.rmtree(EXTRACTED_GAME_PATH)
-        print_debug(pkglist, verbose=True)
-        for pkgfile in pkglist:
-            if not validChecksum(pkgfile[:-4]+".pkg") and validate_checksum:
-                raise Exception("Error: {} has an invalid checksum, please restore the original file!".format(pkgfile))
-            idx_args = [IDXPATH, "hed", "extract", pkgfile, "-o", "extractedout"]
-            print_debug(IDXPATH, "hed", "extract", '"{}"'.format(pkgfile), "-o", '"{}"'.format("extractedout"))
-            try:
-                output = subprocess.check_output(idx_args, stderr=subprocess.STDOUT)
-                print_debug(output, verbose=True)
-            except subprocess.CalledProcessError as err:
-                output = err.output
-                print_debug(output.decode('utf-8'))
-                raise Exception("Extract failed")
-        original_path = os.path.join("extractedout", "original")
-        remastered_path = os.path.join("extractedout", "remastered")
-        if os.path.exists(remastered_path):
-            shutil.move(remastered_path, os.path.join(original_path, "remastered"))
-        shutil.move(original_path, args.extracted_games_path)
-        os.rename(os.path.join(args.extracted_games_path, "original"), EXTRACTED_GAME_PATH)
-    if backup:
-        if not os.path.exists("backup_pkgs"):
-            os.makedirs("backup_pkgs")
-        for pkg in game.pkgs:
-            sourcefn = os.path.join(PKGDIR, pkg)
-            newfn = os.path.join("backup_pkgs", pkg)
-            if not os.path.exists(newfn):
-                print_debug("Backing up file: " + sourcefn)
-                if not validChecksum(sourcefn) and validate_checksum :
-                    raise Exception("Error: {} has an invalid checksum, please restore the original file and try again".format(sourcefn))
-                shutil.copy(sourcefn, newfn)
-                shutil.copy(sourcefn.split(".pkg")[0]+".hed", newfn.split(".pkg")[0]+".hed")
-    if restore:
-        print_debug("Restoring from backup")
-        if not os.path.exists("backup_pkgs"):
-            raise Exception("Backup folder doesn't exist")
-        if fastrestore:
-            if gamename != "Recom" or gamename != "Movies":
-                pkgname = gamename + "_first.pkg"
-                newfn = os.path.join(PKGDIR, pkgname)
-                sourcefn = os.path.join("backup_pkgs", pkgname)
-                if validChecksum(newfn.split(".pkg")[0]+".hed"):
-                    pass
-                else:
-                    print("Restoring {}".format(pkgname))
-                    shutil.copy(sourcefn, newfn)
-                    shutil.copy(sourcefn.split(".pkg")[0]+".hed", newfn.split(".pkg")[0]+".hed")
-        else:
-            for pkg in game.pkgs:
-                newfn = os.path.join(PKGDIR, pkg)
-                sourcefn = os.path.join("backup_pkgs", pkg)
-                if validChecksum(newfn.split(".pkg")[0]+".hed"):
-                    continue
-                else:
-                    print("Restoring {}".format(pkg))
-                    shutil.copy(sourcefn, newfn)
-                    shutil.copy(sourcefn.split(".pkg")[0]+".hed", newfn.split(".pkg")[0]+".hed")
-    if patch:
-        print_debug("Patching")
-        if os.path.exists("khbuild"):
-            shutil.rmtree("khbuild")
-        os.makedirs("khbuild")
-        if os.path.exists(MODDIR):
-            for root, dirs, files in os.walk(MODDIR):
-                path = root.split(os.sep)
-                for file in files:
-                    fn = os.path.join(root, file)
-                    relfn = fn.replace(MODDIR, '')
-                    relfn_trans = game.translate_path(relfn, MODDIR)
-                    print_debug("Translated Filename: {}".format(relfn_trans), verbose=True)
-                    #raw paths are the exact same as original paths, just with the root flder being "raw" instead of "original"
-                    #so we can check against the original path instead of needing to update the pkgmap.
-                    if "raw"+os.sep in relfn_trans:
-                        pkgs = pkgmap.get(relfn_trans.replace("raw"+os.sep, ""), "")
-                    else:
-                        pkgs = pkgmap.get(relfn_trans, "")
-                    pkgsblk = pkgmap_blacklist.get(relfn_trans, "")
-                    if not pkgs:
-                        print_debug("WARNING: Could not find which pkg this path belongs, file not patched: {} (original path {})".format(relfn_trans, relfn))
-                        if not ignoremissing:
-                            raise Exception("Exiting due to warning")
-                        continue
-                    if pkgsblk:
-                        print_debug("WARNING: File blacklisted, file not patched: {})".format(relfn_trans))
-                        if not ignoremissing:
-                            raise Exception("Exiting due to warning")
-                        continue
-                    for pkg in pkgs:
-                        #only patch if the file does not exist in the blacklist pkgmap.
-                        if pkg not in pkgsblk:
-                            #default
-                            pkgname = pkg
-                            #fast_patch forces the pkg name to be the first PKG for all file, if the 
-                            #gamename isn't Recom or Movies as those are only in a single PKG anyway.
-                            if fastpatch:
-                                if gamename != "Recom" or gamename != "Movies":
-                                    pkgname = gamename + "_first"
-                            #"remastered" and "raw" paths are always already in their own folders 
-                            #so no need to add the folder name to the newfn path.
-                            if "remastered"+os.sep in relfn_trans or "raw"+os.sep in relfn_trans:
-                                newfn = os.path.join("khbuild", pkgname, relfn_trans)
-                            else:
-                                newfn = os.path.join("khbuild", pkgname, "original", relfn_trans)
-                            new_basedir = os.path.dirname(newfn)
-                            if not os.path.exists(new_basedir):
-                                os.makedirs(new_basedir)
-                            shutil.copy(fn, newfn)
-        other_patches = []
-        if extra_patches_dir and os.path.exists(extra_patches_dir):
-            other_patches = [os.path.join(extra_patches_dir,p) for p in os.listdir(extra_patches_dir) if p.endswith(".kh2pcpatch")] #TODO double check extension
-        zipped_files = {}
-        for patch in sorted(other_patches):
-            # Read the patch in as a zip, or extract it out to some temp dir
-            # copy the files in based on the pkgmap
-            input_zip=ZipFile(patch)
-            for name in input_zip.namelist():
-                zipped_files[name] = input_zip.read(name)
-        for fn in zipped_files:
-            if len(zipped_files[fn]) == 0:
-                continue
-            #default
-            fastfn = fn
-            #extract all kh2pcpatch files to the first PKG if fast_patch is used.
-            if fastpatch:
-                if gamename != "Recom" or gamename != "Movies":
-                    if "/original/" in fn:
-                        fastfn = gamename+"_first/original/"+fn.split("/original/")[1]
-                    elif "/remastered/" in fn:
-                        fastfn = gamename+"_first/remastered/"+fn.split("/remastered/")[1]
-                    elif "/raw/" in fn:
-                        fastfn = gamename+"_first/raw/"+fn.split("/raw/")[1]
-            newfn = os.path.join("khbuild", fastfn)
-            # mods manager needs to take priority
-            if not os.path.exists(newfn): 
-                new_basedir = os.path.dirname(newfn)
-                if not os.path.exists(new_basedir):
-                    os.makedirs(new_basedir)
-                open(newfn, "wb").write(zipped_files[fn])
-        for pkg in os.listdir("khbuild"):
-            pkgfile = os.path.join(PKGDIR, pkg+".pkg")
-            modfolder = os.path.join("khbuild", pkg)
-            if not os.path.exists(os.path.join(modfolder, "remastered")):
-                os.makedirs(os.path.join(modfolder, "remastered"))
-            if not os.path.exists(os.path.join(modfolder, "original")):
-                os.makedirs(os.path.join(modfolder, "original"))
-            if not os.path.exists(os.path.join(modfolder, "raw")):
-                os.makedirs(os.path.join(modfolder, "raw"))
-            if os.path.exists("pkgoutput"):
-                shutil.rmtree("pkgoutput")
-            print_debug("Patching: {}".format(pkg))
-            args = [IDXPATH, "hed", "patch", pkgfile, modfolder, "-o", "pkgoutput"]
-            #print_debug(IDXPATH, "hed", "patch", '"{}"'.format(pkgfile), '"modfolder"', "-o", '"{}"'.format("pkgoutput"))
-            try:
-                print_debug(args, verbose=False)
-                output = subprocess.check_output(args, stderr=subprocess.STDOUT).decode('utf-8').replace("\n", "")
-                print_debug(output, verbose=True)
-            except subprocess.CalledProcessError as err:
-                output = err.output
-                print(output.decode('utf-8'))
-                raise Exception("Patch failed")
-            shutil.copy(os.path.join("pkgoutput", pkg+".pkg"), os.path.join(PKGDIR, pkg+".pkg"))
-            shutil.copy(os.path.join("pkgoutput", pkg+".hed"), os.path.join(PKGDIR, pkg+".hed"))
-        if not keepkhbuild:
-            shutil.rmtree("khbuild")
-    print_debug("All done! Took {}s".format(round(time.time()-starttime, 2)) + " | Mode: " + mode)
+    session = PatchSession(args.openkh_path, args.khgame_path, extracted_games_path=args.extracted_games_path, patches_path=args.patches_path,
+                           region=args.region, workers=args.workers, keepkhbuild=args.keepkhbuild, ignorebadchecksum=args.ignorebadchecksum,
+                           failonmissing=args.failonmissing, appendpatch=args.appendpatch, compressbackup=args.compressbackup, profile=args.profile,
+                           include=args.include, exclude=args.exclude, plan_path=args.plan, timeout=args.timeout)
+    if args.mode == "watch":
+        if len(args.game) > 1:
+            raise Exception("Watch mode only works on one game at a time")
+        session.watch(args.game[0], debounce=args.debounce)
+    else:
+        session.batch(args.game, args.mode, resume=args.resume)
 
 if __name__ == "__main__":
     import sys
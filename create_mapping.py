@@ -1,28 +1,120 @@
-import json, os
-
-x = {}
-
-x_r = {}
-
-for root, dirs, files in os.walk("extracted_pkgs"):
-    #if "remastered" in root:
-    #    continue
-    path = root.split(os.sep)
-    if not len(path) > 1:
-        print("skipping {}".format(path))
-        continue
-    pkg = path[1]
-    game = pkg.split("_")[0]
-    if not game in x:
-        x[game] = {}
-    for file in files:
-        if path[2] == "remastered":
-            relpath = os.path.join(*path[2:],file)
+import json, os, argparse, hashlib
+from hedfile import readHed, nameHash, pkgName
+
+PKGMAP_PATH = "pkgmap.json"
+HED_STATE_PATH = "pkgmap_heds.json"
+
+def mappingFromExtracted(extracted_path="extracted_pkgs"):
+    x = {}
+    for root, dirs, files in os.walk(extracted_path):
+        #if "remastered" in root:
+        #    continue
+        path = root.split(os.sep)
+        if not len(path) > 1:
+            print("skipping {}".format(path))
+            continue
+        pkg = path[1]
+        game = pkg.split("_")[0]
+        if not game in x:
+            x[game] = {}
+        for file in files:
+            if path[2] == "remastered":
+                relpath = os.path.join(*path[2:],file)
+            else:
+                relpath = os.path.join(*path[3:],file)
+            #relpath = os.path.join(*path[2:],file)
+            if relpath not in x[game]:
+                x[game][relpath] = []
+            x[game][relpath].append(pkg)
+    return x
+
+def findHeds(heddirs):
+    heds = []
+    for heddir in heddirs:
+        heds += [os.path.join(heddir, p) for p in sorted(os.listdir(heddir)) if p.endswith(".hed")]
+    return heds
+
+def hedGame(hedfile):
+    return pkgName(hedfile).split("_")[0]
+
+def changedGames(heds, state):
+    #games with a hed that is new, gone or has a different md5 than when the pkgmap was last generated
+    current = {os.path.basename(h): hashlib.md5(open(h, "rb").read()).hexdigest() for h in heds}
+    changed = set()
+    for hedname in set(current) | set(state):
+        if current.get(hedname) != state.get(hedname):
+            changed.add(hedGame(hedname))
+    return changed, current
+
+def mappingFromHeds(heds, candidates, existing={}, games=None):
+    #looks every candidate filename up in the hed name hashes, nothing is extracted.
+    #remastered files live inside the pkg assets rather than in the hed, so those entries
+    #are kept from the existing pkgmap. games that aren't being regenerated are kept as is
+    hashes = {nameHash(name): name.replace("\\", "/").replace("/", os.sep) for name in candidates if not name.replace("\\", "/").startswith("remastered/")}
+    x = {}
+    for game, entries in existing.items():
+        if games is None or game in games:
+            x[game] = {path: pkgs for path, pkgs in entries.items() if path.replace("\\", "/").startswith("remastered/")}
         else:
-            relpath = os.path.join(*path[3:],file)
-        #relpath = os.path.join(*path[2:],file)
-        if relpath not in x[game]:
-            x[game][relpath] = []
-        x[game][relpath].append(pkg)
+            x[game] = entries
+    for hedfile in heds:
+        game = hedGame(hedfile)
+        if games is not None and game not in games:
+            continue
+        pkg = pkgName(hedfile)
+        entries = x.setdefault(game, {})
+        unresolved = 0
+        for entry in readHed(hedfile):
+            relpath = hashes.get(entry.name)
+            if relpath is None:
+                unresolved += 1
+                continue
+            if relpath not in entries:
+                entries[relpath] = []
+            if pkg not in entries[relpath]:
+                entries[relpath].append(pkg)
+        if unresolved:
+            print("{}: {} entries have no known filename".format(pkg, unresolved))
+    return x
+
+def main(cli_args=None):
+    parser = argparse.ArgumentParser(description="Builds pkgmap.json, either from extracted_pkgs or straight from the .hed files")
+    parser.add_argument("-heds", nargs="+", help="Folders containing the .hed files (e.g. <game>/Image/en). If not given, extracted_pkgs is walked instead")
+    parser.add_argument("-names", help="Text file with one candidate filename per line")
+    parser.add_argument("-existing", default=PKGMAP_PATH, help="Existing pkgmap, its filenames are used as candidates and games that aren't regenerated are kept")
+    parser.add_argument("-game", nargs="+", help="Only regenerate these games")
+    parser.add_argument("-changed", action="store_true", default=False, help="Only regenerate games whose .hed files changed since the last run")
+    parser.add_argument("-o", default=PKGMAP_PATH, help="Where to write the pkgmap")
+    args = parser.parse_args(cli_args)
+
+    if not args.heds:
+        json.dump(mappingFromExtracted(), open(args.o, "w"))
+        return
+
+    existing = json.load(open(args.existing)) if os.path.exists(args.existing) else {}
+    candidates = set()
+    for entries in existing.values():
+        candidates.update(entries)
+    if args.names:
+        candidates.update(line.strip() for line in open(args.names) if line.strip())
+
+    heds = findHeds(args.heds)
+    games = set(args.game) if args.game else None
+    state = json.load(open(HED_STATE_PATH)) if os.path.exists(HED_STATE_PATH) else {}
+    changed, current = changedGames(heds, state)
+    if args.changed:
+        games = changed if games is None else games & changed
+        print("Regenerating: {}".format(", ".join(sorted(games)) or "nothing"))
+    x = mappingFromHeds(heds, candidates, existing, games)
+    json.dump(x, open(args.o, "w"))
+    #only the regenerated games are up to date now, the others have to stay changed for the next -changed run
+    for hedname in set(current) | set(state):
+        if games is None or hedGame(hedname) in games:
+            if hedname in current:
+                state[hedname] = current[hedname]
+            else:
+                state.pop(hedname, None)
+    json.dump(state, open(HED_STATE_PATH, "w"))
 
-json.dump(x, open("pkgmap.json", "w"))
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import hashlib, os, struct
+from collections import namedtuple
+
+# .hed files are the index of a .pkg: a flat list of 0x20 byte entries, one per asset.
+# name is the md5 of the asset's filename (e.g. "bgm/music140.win32.scd"), offset is where
+# the asset starts in the pkg, data_length is how many bytes it takes up there and
+# actual_length is its size once decoded.
+HED_ENTRY = struct.Struct("<16sqii")
+
+HedEntry = namedtuple("HedEntry", ["name", "offset", "data_length", "actual_length"])
+
+def nameHash(name):
+    return hashlib.md5(name.replace("\\", "/").encode("utf-8")).digest()
+
+def readHed(path):
+    data = open(path, "rb").read()
+    if len(data) % HED_ENTRY.size:
+        raise Exception("{} is not a valid hed file".format(path))
+    return [HedEntry(*entry) for entry in HED_ENTRY.iter_unpack(data)]
+
+def writeHed(path, entries):
+    with open(path, "wb") as f:
+        for entry in entries:
+            f.write(HED_ENTRY.pack(*entry))
+
+def hedNames(path):
+    return set(entry.name for entry in readHed(path))
+
+def resolveNames(candidates, hashes):
+    #candidates are filenames in any separator style, returns the ones whose hash is in hashes
+    return [name for name in candidates if nameHash(name) in hashes]
+
+def pkgName(path):
+    return os.path.basename(path).rsplit(".", 1)[0]
+
+def filterHed(src, dst, names):
+    #writes a hed with only the entries whose name hash is in names, still pointing into the same pkg
+    writeHed(dst, [entry for entry in readHed(src) if entry.name in names])
+
+def appendAssets(pkgfile, hedfile, deltapkg, deltahed, align=16):
+    #copies every asset of deltapkg to the end of pkgfile and points the hed at the copies, assets the
+    #hed doesn't know yet are added to it. the existing data is never touched, so if this is interrupted
+    #the old hed still describes a valid pkg, and truncating back to the returned size undoes it
+    entries = readHed(hedfile)
+    delta = readHed(deltahed)
+    appended = {}
+    with open(pkgfile, "r+b") as pkg, open(deltapkg, "rb") as src:
+        pkg.seek(0, os.SEEK_END)
+        base_size = pkg.tell()
+        for entry in delta:
+            padding = -pkg.tell() % align
+            if padding:
+                pkg.write(b"\0" * padding)
+            offset = pkg.tell()
+            src.seek(entry.offset)
+            remaining = entry.data_length
+            while remaining:
+                chunk = src.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise Exception("{} is truncated".format(deltapkg))
+                pkg.write(chunk)
+                remaining -= len(chunk)
+            appended[entry.name] = entry._replace(offset=offset)
+        pkg.flush()
+        os.fsync(pkg.fileno())
+    newentries = [appended.pop(entry.name, entry) for entry in entries]
+    newentries += [appended[entry.name] for entry in delta if entry.name in appended]
+    writeHed(hedfile + ".tmp", newentries)
+    os.replace(hedfile + ".tmp", hedfile)
+    return base_size
+
+def truncatePkg(pkgfile, size):
+    with open(pkgfile, "r+b") as f:
+        f.truncate(size)
@@ -0,0 +1,27 @@
+# Shared fixtures: a small synthetic game install made by bench/generate.py, run with the IdxImg stand-in
+import os, sys, json
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "bench"))
+
+import build_from_mm
+import generate
+
+@pytest.fixture
+def install(tmp_path, monkeypatch):
+    #a kh2 install with mods in tmp_path, which is also the working folder so the state files end up there
+    root = str(tmp_path)
+    assets = generate.makeGame(root, "kh2", assets_per_pkg=20, asset_size=4096)
+    generate.makeMods(root, assets, mod_files=10, patches=1, patch_files=10, file_size=4096)
+    generate.makeOpenKh(root)
+    monkeypatch.chdir(root)
+    #in place, checksum_tables holds the same dict
+    for name, checksum in json.load(open("checksums.json")).items():
+        monkeypatch.setitem(build_from_mm.checksums, name, checksum)
+    monkeypatch.setattr(build_from_mm, "_checksum_cache", None)
+    monkeypatch.delenv("FAKE_IDXIMG_DELAY", raising=False)
+    build_from_mm._idximg_cancelled.clear()
+    yield root
+    build_from_mm._idximg_cancelled.clear()
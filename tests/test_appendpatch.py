@@ -0,0 +1,76 @@
+import os, json
+import pytest
+
+import build_from_mm
+import generate
+import hedfile
+
+def session(root):
+    return build_from_mm.PatchSession(os.path.join(root, "openkh"), os.path.join(root, "game"), extracted_games_path=os.path.join(root, "extracted"),
+                                      patches_path=os.path.join(root, "patches"), appendpatch=True)
+
+def gameChecksums(root):
+    pkgdir = generate.pkgDir(root, "kh2")
+    return {name: build_from_mm.md5File(os.path.join(pkgdir, name)) for name in json.load(open("checksums.json"))}
+
+def pkgSizes(root):
+    pkgdir = generate.pkgDir(root, "kh2")
+    return {name: os.path.getsize(os.path.join(pkgdir, name)) for name in os.listdir(pkgdir) if name.endswith(".pkg")}
+
+def test_restore_after_append(install):
+    original = json.load(open("checksums.json"))
+    sizes = pkgSizes(install)
+    session(install).run("kh2", "patch")
+    patched = gameChecksums(install)
+    grown = [name for name, size in pkgSizes(install).items() if size > sizes[name]]
+    assert grown
+    assert all(patched[name] != original[name] for name in grown)
+    session(install).run("kh2", "restore")
+    assert gameChecksums(install) == original
+
+def test_restore_after_repatching(install):
+    original = json.load(open("checksums.json"))
+    session(install).run("kh2", "patch")
+    for root, dirs, files in os.walk(os.path.join(install, "openkh", "mod")):
+        for file in files:
+            open(os.path.join(root, file), "ab").write(b"changed")
+    session(install).run("kh2", "patch")
+    session(install).run("kh2", "restore")
+    assert gameChecksums(install) == original
+
+def test_restore_after_interrupted_append(install, monkeypatch):
+    #the new assets are already at the end of the pkg but the hed pointing at them was never written
+    original = json.load(open("checksums.json"))
+    sizes = pkgSizes(install)
+    appendAssets = hedfile.appendAssets
+    def powerCut(path, entries):
+        raise KeyboardInterrupt()
+    with monkeypatch.context() as m:
+        def interruptedAppend(*args, **kwargs):
+            m.setattr(hedfile, "writeHed", powerCut)
+            return appendAssets(*args, **kwargs)
+        m.setattr(hedfile, "appendAssets", interruptedAppend)
+        with pytest.raises(KeyboardInterrupt):
+            session(install).run("kh2", "patch")
+    pkgdir = os.path.abspath(generate.pkgDir(install, "kh2"))
+    journal = json.load(open(build_from_mm.RESTORE_JOURNAL_PATH))["pkgs"][pkgdir]
+    pending = [pkg for pkg, entry in journal.items() if entry["state"] == "pending"]
+    assert len(pending) == 1
+    assert pkgSizes(install)[pending[0]+".pkg"] > sizes[pending[0]+".pkg"]
+    session(install).run("kh2", "restore")
+    assert gameChecksums(install) == original
+    assert not json.load(open(build_from_mm.RESTORE_JOURNAL_PATH))["pkgs"][pkgdir]
+
+def test_fast_restore_uses_the_journal(install, monkeypatch):
+    #fast modes only ever look at kh2_first, it still gets checksummed once and journaled after that
+    original = json.load(open("checksums.json"))
+    session(install).run("kh2", "fast_patch")
+    session(install).run("kh2", "fast_patch")
+    pkgdir = os.path.abspath(generate.pkgDir(install, "kh2"))
+    assert json.load(open(build_from_mm.RESTORE_JOURNAL_PATH))["scanned"][pkgdir] == ["kh2_first"]
+    truncated = []
+    truncatePkg = hedfile.truncatePkg
+    monkeypatch.setattr(hedfile, "truncatePkg", lambda *args: truncated.append(args) or truncatePkg(*args))
+    session(install).run("kh2", "fast_restore")
+    assert [os.path.basename(pkgfile) for pkgfile, size in truncated] == ["kh2_first.pkg"]
+    assert gameChecksums(install) == original
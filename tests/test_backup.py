@@ -0,0 +1,28 @@
+import os, json, shutil
+import pytest
+
+import build_from_mm
+import generate
+
+def session(root, game="game"):
+    return build_from_mm.PatchSession(os.path.join(root, "openkh"), os.path.join(root, game), patches_path=os.path.join(root, "patches"))
+
+def gameChecksums(root, game="game"):
+    pkgdir = os.path.join(root, game, "Image", "en")
+    return {name: build_from_mm.md5File(os.path.join(pkgdir, name)) for name in json.load(open("checksums.json"))}
+
+def test_restore_after_moving_the_install(install):
+    #the backups were indexed under the old path, the patched files must not be backed up as the originals
+    original = json.load(open("checksums.json"))
+    session(install).run("kh2", "patch")
+    shutil.move(os.path.join(install, "game"), os.path.join(install, "moved"))
+    session(install, "moved").run("kh2", "patch")
+    session(install, "moved").run("kh2", "restore")
+    assert gameChecksums(install, "moved") == original
+
+def test_patched_file_without_backup_is_not_backed_up(install):
+    pkgfile = os.path.join(generate.pkgDir(install, "kh2"), "kh2_first.pkg")
+    open(pkgfile, "ab").write(b"patched")
+    with pytest.raises(Exception, match="invalid checksum"):
+        session(install).run("kh2", "patch")
+    assert not os.path.exists(os.path.join(build_from_mm.BACKUP_STORE_DIR, "files", build_from_mm.md5File(pkgfile) + ".json"))
@@ -0,0 +1,77 @@
+import os, sys, time, threading
+import pytest
+
+import build_from_mm
+import generate
+
+def idxPath(root):
+    return os.path.join(root, "openkh", "OpenKh.Command.IdxImg.exe")
+
+def modFolder(root):
+    #a khbuild folder replacing every asset of kh2_first, whichever folder generate put it in
+    modfolder = os.path.join(root, "khbuild", "kh2_first")
+    for folder in generate.ASSET_DIRS:
+        os.makedirs(os.path.join(modfolder, "original", folder))
+        for i in range(20):
+            open(os.path.join(modfolder, "original", folder, "kh2_first_{:05d}.bin".format(i)), "wb").write(b"modded")
+    return modfolder
+
+def test_timeout_leaves_no_output(install, monkeypatch):
+    monkeypatch.setenv("FAKE_IDXIMG_DELAY", "0.2")
+    pkgfile = os.path.join(generate.pkgDir(install, "kh2"), "kh2_first.pkg")
+    outputdir = os.path.join(install, "pkgoutput", "kh2_first")
+    starttime = time.time()
+    with pytest.raises(Exception, match="timed out"):
+        build_from_mm.runPatch(idxPath(install), pkgfile, modFolder(install), outputdir, timeout=0.5)
+    assert time.time() - starttime < 3
+    assert not os.path.exists(outputdir)
+
+def test_extract_timeout_leaves_no_output(install, monkeypatch):
+    monkeypatch.setenv("FAKE_IDXIMG_DELAY", "0.2")
+    hedfn = os.path.join(generate.pkgDir(install, "kh2"), "kh2_first.hed")
+    outputdir = os.path.join(install, "extractedout", "kh2_first")
+    with pytest.raises(Exception, match="timed out"):
+        build_from_mm.runExtract(idxPath(install), hedfn, outputdir, timeout=0.5)
+    assert not os.path.exists(outputdir)
+
+def test_cancel_kills_idximg(install, monkeypatch):
+    monkeypatch.setenv("FAKE_IDXIMG_DELAY", "0.2")
+    hedfn = os.path.join(generate.pkgDir(install, "kh2"), "kh2_first.hed")
+    outputdir = os.path.join(install, "extractedout", "kh2_first")
+    errors = []
+    def extract():
+        try:
+            build_from_mm.runExtract(idxPath(install), hedfn, outputdir)
+        except Exception as err:
+            errors.append(err)
+    thread = threading.Thread(target=extract)
+    thread.start()
+    deadline = time.time() + 5
+    while not build_from_mm._idximg_running and time.time() < deadline:
+        time.sleep(0.01)
+    procs = list(build_from_mm._idximg_running)
+    assert procs
+    build_from_mm.cancelIdxImg()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert all(proc.poll() is not None for proc in procs)
+    assert "cancelled" in str(errors[0])
+    assert not os.path.exists(outputdir)
+    #jobs that hadn't started yet fail without running IdxImg
+    with pytest.raises(Exception, match="cancelled"):
+        build_from_mm.runExtract(idxPath(install), hedfn, outputdir)
+
+def test_progress_from_line_count(monkeypatch, capsys):
+    #output without "[i/total]" counters is counted against the hed's entries
+    monkeypatch.setattr(build_from_mm, "IDXIMG_PROGRESS_INTERVAL", 0)
+    script = "import time\nfor i in range(4):\n    print('bgm/music{}.scd'.format(i), flush=True)\n    time.sleep(0.05)\n"
+    build_from_mm.runIdxImg([sys.executable, "-c", script], "Extract of test.hed", total=4)
+    output = capsys.readouterr().out
+    assert "Extract of test.hed: 2/4 (50%)" in output
+    assert "Extract of test.hed: 4/4 (100%)" in output
+
+def test_progress_from_counter(install, monkeypatch, capsys):
+    monkeypatch.setattr(build_from_mm, "IDXIMG_PROGRESS_INTERVAL", 0)
+    hedfn = os.path.join(generate.pkgDir(install, "kh2"), "kh2_first.hed")
+    build_from_mm.runExtract(idxPath(install), hedfn, os.path.join(install, "extractedout", "kh2_first"))
+    assert "Extract of kh2_first.hed: 20/20 (100%)" in capsys.readouterr().out
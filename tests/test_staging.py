@@ -0,0 +1,34 @@
+import os
+from zipfile import ZipFile
+
+import build_from_mm
+
+def session(root):
+    return build_from_mm.PatchSession(os.path.join(root, "openkh"), os.path.join(root, "game"), patches_path=os.path.join(root, "patches"))
+
+def test_mod_files_win_over_members_differing_in_case(install, monkeypatch):
+    #what windows' case insensitive paths look like
+    monkeypatch.setattr(os.path, "normcase", lambda path: path.lower())
+    plan = session(install).plan("kh2")
+    newfn = sorted(fn for fn, entry in plan.files.items() if entry["member"] is None)[0]
+    with ZipFile(os.path.join(install, "patches", "zz_case.kh2pcpatch"), "w") as z:
+        z.writestr(newfn.upper().replace(os.sep, "/"), b"from the patch")
+    plan = session(install).plan("kh2")
+    assert not [fn for fn in plan.files if fn != newfn and fn.lower() == newfn.lower()]
+    assert plan.files[newfn]["member"] is None
+
+def test_patch_members_never_write_through_staged_links(install):
+    modfn = os.path.join(install, "mod.bin")
+    open(modfn, "wb").write(b"mod")
+    buildpath = os.path.join(install, "khbuild")
+    os.makedirs(os.path.join(buildpath, "kh2_first", "original"))
+    staged = os.path.join(buildpath, "kh2_first", "original", "a.bin")
+    os.link(modfn, staged)
+    patch = os.path.join(install, "test.kh2pcpatch")
+    with ZipFile(patch, "w") as z:
+        z.writestr("kh2_first/original/a.bin", b"from the patch")
+    with ZipFile(patch) as z:
+        info = z.getinfo("kh2_first/original/a.bin")
+    build_from_mm.extractPatchFile(patch, [(info, os.path.join("kh2_first", "original", "a.bin"))], buildpath)
+    assert open(staged, "rb").read() == b"from the patch"
+    assert open(modfn, "rb").read() == b"mod"
@@ -0,0 +1,23 @@
+import os, time
+
+import build_from_mm
+
+def modFile(root):
+    moddir = os.path.join(root, "openkh", "mod")
+    return sorted(os.path.join(dirpath, file) for dirpath, dirs, files in os.walk(moddir) if "remastered" not in dirpath for file in files)[0]
+
+def test_affected_pkgs_with_relative_openkh_path(install):
+    #watchers report absolute or relative paths, either has to match a relative openkh_path
+    session = build_from_mm.PatchSession("openkh", "game", patches_path="patches")
+    fn = modFile(install)
+    expected = session.affectedPkgs("kh2", [os.path.relpath(fn)])
+    assert expected
+    assert session.affectedPkgs("kh2", [os.path.abspath(fn)]) == expected
+
+def test_poll_watcher_waits_for_timeout(install):
+    watcher = build_from_mm.PollWatcher([os.path.join(install, "openkh", "mod")], interval=0.05)
+    starttime = time.time()
+    assert watcher.changes(0.5) == set()
+    assert time.time() - starttime >= 0.5
+    open(modFile(install), "ab").write(b"changed")
+    assert watcher.changes(5) == {modFile(install)}